@@ -0,0 +1,372 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmarks of the hot paths: the main views, the BBCode render path and
+the maintenance commands, on a synthetic forum.
+
+generate fills the database with forums, topics, posts, users,
+attachments and group restricted forums. Each case is then measured by
+measure, or by run_isolated which forks and runs the case on a copy of the
+SQLite database file, so that a case writing posts doesn't change the data
+of the next one and the peak memory is the case's own. A result holds the
+first (cold cache) run and the best of the following ones:
+
+    {'cold_time': s, 'cold_queries': n, 'time': s, 'queries': n,
+     'query_time': s, 'memory_kb': kb}
+
+check_budgets compares results with stored budgets of the same shape;
+the lbforum_benchmark command ties everything together.
+"""
+import json
+import os
+import random
+import shutil
+import time
+import traceback
+from StringIO import StringIO
+
+from django.contrib.auth.models import User, Group
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test.client import Client
+
+from attachments.models import Attachment
+
+from lbforum.models import Category, Forum, Topic, Post, LBForumUserProfile
+from lbforum.rebuild import id_ranges, rebuild_topics, rebuild_forums
+from lbforum.render import render_post, store_rendering
+from lbforum.templatetags.bbcode import get_attachments_map
+
+BENCH_USERNAME = 'bench'
+BENCH_PASSWORD = 'bench'
+
+DEFAULT_SIZES = {
+    'forums': 10,
+    'topics': 1000,
+    'posts': 20000,
+    'users': 200,
+    'attachments': 500,
+    'restricted': 2,
+}
+
+_WORDS = (u'lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+          u'eiusmod tempor incididunt ut labore et dolore magna aliqua '
+          u'\u8bba\u575b \u6d4b\u8bd5 \u5e16\u5b50').split()
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def _words(rand, low, high):
+    return u' '.join(rand.choice(_WORDS) for i in range(rand.randint(low, high)))
+
+
+def _message(rand, attach_ids):
+    '''
+    A message with a mix of the BBCode tags posts use, and the id of the
+    attachment it references or None.
+    '''
+    parts = [_words(rand, 5, 80)]
+    if rand.random() < 0.3:
+        parts.insert(0, u'[quote=user]%s[/quote]' % _words(rand, 5, 30))
+    if rand.random() < 0.3:
+        parts.append(u'[b]%s[/b] [url]http://example.com/%s[/url]'
+                     % (_words(rand, 1, 5), rand.randint(1, 1000)))
+    if rand.random() < 0.1:
+        parts.append(u'[hide]%s[/hide]' % _words(rand, 5, 20))
+    if rand.random() < 0.05:
+        parts.append(u'[html]<p style="color: red" onclick="x()">%s</p>'
+                     u'<script>alert(1)</script>[/html]' % _words(rand, 5, 20))
+    attach_id = None
+    if attach_ids and rand.random() < 0.2:
+        attach_id = rand.choice(attach_ids)
+        parts.append(u'[attach]%s[/attach]' % attach_id)
+    return u'\n\n'.join(parts), attach_id
+
+
+def _next_pk(model):
+    pks = model._default_manager.order_by('-pk').values_list('pk', flat=True)
+    pks = pks[:1]
+    return (pks and pks[0] or 0) + 1
+
+
+@transaction.commit_on_success
+def generate(forums=10, topics=1000, posts=20000, users=200, attachments=500,
+             restricted=2, seed=0):
+    '''
+    Create a synthetic forum and return the context the cases need. Rows
+    are inserted with bulk_create and explicit ids, the counters are then
+    computed like rebuild_forum_stats does.
+    :param restricted: Number of forums restricted to a group, the bench
+    user is a member of the group of every other one
+    '''
+    rand = random.Random(seed)
+    topics = max(topics, 1)
+    posts = max(posts, topics)
+    bench_user = User(username=BENCH_USERNAME)
+    bench_user.set_password(BENCH_PASSWORD)
+    bench_user.save()
+    first_user_id = _next_pk(User)
+    User.objects.bulk_create([
+        User(pk=first_user_id + i, username=u'user%s' % i, password='!')
+        for i in range(users)])
+    user_ids = [bench_user.pk] + range(first_user_id, first_user_id + users)
+    LBForumUserProfile.objects.bulk_create([
+        LBForumUserProfile(user_id=e) for e in user_ids[1:]])
+
+    first_attach_id = _next_pk(Attachment)
+    Attachment.objects.bulk_create([
+        Attachment(pk=first_attach_id + i, user_id=rand.choice(user_ids),
+                   file=u'attachments/bench%s.png' % i,
+                   org_filename=u'bench%s.png' % i, suffix=u'png',
+                   is_img=bool(i % 2), activated=True)
+        for i in range(attachments)])
+    attach_ids = range(first_attach_id, first_attach_id + attachments)
+
+    category = Category.objects.create(name=u'bench')
+    first_forum_id = _next_pk(Forum)
+    Forum.objects.bulk_create([
+        Forum(pk=first_forum_id + i, name=u'bench %s' % i,
+              slug=u'bench-%s' % (first_forum_id + i), category=category)
+        for i in range(max(forums, 1))])
+    forum_ids = range(first_forum_id, first_forum_id + max(forums, 1))
+    for i, forum_id in enumerate(forum_ids[:restricted]):
+        group = Group.objects.create(name=u'bench %s' % forum_id)
+        Forum.objects.get(pk=forum_id).groups.add(group)
+        if i % 2:
+            bench_user.groups.add(group)
+
+    first_topic_id = _next_pk(Topic)
+    first_post_id = _next_pk(Post)
+    topic_ids = range(first_topic_id, first_topic_id + topics)
+    # the first post of each topic comes first, the replies follow
+    post_topics = topic_ids + [rand.choice(topic_ids)
+                               for i in range(posts - topics)]
+    posters = dict((e, rand.choice(user_ids)) for e in topic_ids)
+    Topic.objects.bulk_create([
+        Topic(pk=topic_id, forum_id=forum_ids[i % len(forum_ids)],
+              posted_by_id=posters[topic_id], post_id=first_post_id + i,
+              subject=_words(rand, 2, 10))
+        for i, topic_id in enumerate(topic_ids)])
+    positions = dict((e, 0) for e in topic_ids)
+    post_rows = []
+    attach_rows = []
+    for i, topic_id in enumerate(post_topics):
+        positions[topic_id] += 1
+        message, attach_id = _message(rand, attach_ids)
+        post = Post(pk=first_post_id + i, topic_id=topic_id,
+                    posted_by_id=i < topics and posters[topic_id] or
+                    rand.choice(user_ids),
+                    poster_ip='127.0.0.1', topic_post=i < topics,
+                    position=positions[topic_id],
+                    message=message)
+        store_rendering(post)
+        post_rows.append(post)
+        if attach_id:
+            attach_rows.append(Post.attachments.through(
+                post_id=post.pk, attachment_id=attach_id))
+        if len(post_rows) == 1000:
+            Post.objects.bulk_create(post_rows)
+            post_rows = []
+    Post.objects.bulk_create(post_rows)
+    Post.attachments.through.objects.bulk_create(attach_rows)
+
+    for first_id, last_id in id_ranges(Topic, 10000):
+        rebuild_topics(first_id, last_id)
+    for first_id, last_id in id_ranges(Forum, 10000):
+        rebuild_forums(first_id, last_id)
+    num_posts = list(Post.objects.values('posted_by').annotate(
+        n=Count('id')).order_by('-n').values_list('posted_by', 'n'))
+    for user_id, n in num_posts:
+        LBForumUserProfile.objects.filter(user=user_id).update(num_posts=n)
+    busiest = Topic.objects.filter(forum__in=forum_ids[restricted:] or
+                                   forum_ids).order_by('-num_replies')[0]
+    return {
+        'username': BENCH_USERNAME,
+        'forum_slug': busiest.forum.slug,
+        'topic_id': busiest.pk,
+        'poster_id': num_posts[0][0],
+    }
+
+
+def _view(url_name, args=lambda ctx: ()):
+    def run(client, ctx):
+        response = client.get(reverse(url_name, args=args(ctx)))
+        if response.status_code != 200:
+            raise BenchmarkError('%s returned %s'
+                                 % (url_name, response.status_code))
+    return run
+
+
+def _new_post(client, ctx):
+    response = client.post(
+        reverse('lbforum_new_replay', args=[ctx['topic_id']]),
+        {'subject': u'', 'message': u'[b]bench[/b] reply', 'submit': u'1'})
+    if response.status_code != 302:
+        raise BenchmarkError('new_post returned %s' % response.status_code)
+
+
+def _render_bbcode(client, ctx):
+    # the render path of a topic page without stored renderings
+    cache.clear()
+    posts = list(Post.objects.filter(topic=ctx['topic_id']).order_by(
+        'position')[:20])
+    attachments = get_attachments_map([e.message for e in posts])
+    for post in posts:
+        render_post(post.pk, post.message, True, attachments)
+
+
+def _command(name, **options):
+    def run(client, ctx):
+        call_command(name, stdout=StringIO(), **options)
+    return run
+
+
+CASES = (
+    ('view_index', _view('lbforum_index')),
+    ('view_forum', _view('lbforum_forum', lambda ctx: [ctx['forum_slug']])),
+    ('view_topic', _view('lbforum_topic', lambda ctx: [ctx['topic_id']])),
+    ('view_recent', _view('lbforum_recent')),
+    ('view_new_post', _new_post),
+    ('view_user_posts', _view('lbforum_user_posts',
+                              lambda ctx: [ctx['poster_id']])),
+    ('render_bbcode', _render_bbcode),
+    ('command_update_posts', _command('update_posts')),
+    ('command_set_topic_post', _command('lbforum_set_topic_post')),
+    ('command_init_user_profile', _command('init_lbforum_user_profile')),
+    ('command_update_user_num_posts',
+     _command('lbforum_update_user_num_posts')),
+    ('command_rebuild_forum_stats', _command('rebuild_forum_stats',
+                                             processes=1)),
+    ('command_rebuild_search_index',
+     _command('lbforum_rebuild_search_index')),
+    ('command_rerender_posts', _command('rerender_posts', processes=1,
+                                        all=True)),
+)
+
+
+def _memory_kb(field):
+    '''
+    VmRSS, VmHWM... of this process in kB, None without /proc.
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def _reset_peak_memory():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            # resets VmHWM to the current RSS (Linux 4.0+)
+            f.write('5')
+    except IOError:
+        pass
+
+
+def measure(func, ctx, repeat=3):
+    '''
+    Run a case once with cold caches then repeat times, in this process.
+    '''
+    cache.clear()
+    client = Client()
+    client.login(username=ctx['username'], password=BENCH_PASSWORD)
+    old_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    _reset_peak_memory()
+    start_rss = _memory_kb('VmRSS')
+    runs = []
+    try:
+        for i in range(repeat + 1):
+            connection.queries = []
+            start = time.time()
+            func(client, ctx)
+            elapsed = time.time() - start
+            query_time = sum(float(e['time']) for e in connection.queries)
+            runs.append((elapsed, len(connection.queries), query_time))
+    finally:
+        connection.use_debug_cursor = old_debug_cursor
+        connection.queries = []
+    peak = _memory_kb('VmHWM')
+    memory = None
+    if peak is not None and start_rss is not None:
+        memory = max(peak - start_rss, 0)
+    cold, warm = runs[0], runs[1:] or runs[:1]
+    best = min(warm)
+    return {
+        'cold_time': cold[0],
+        'cold_queries': cold[1],
+        'time': best[0],
+        'queries': max(e[1] for e in warm),
+        'query_time': best[2],
+        'memory_kb': memory,
+    }
+
+
+def run_isolated(func, ctx, repeat=3):
+    '''
+    measure a case in a forked process working on a copy of the SQLite
+    database file; failures are returned as ``{'error': traceback}``.
+    '''
+    source = connection.settings_dict['NAME']
+    # the child opens its own connection to the copy
+    connection.close()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_fd)
+        copy = '%s.%s' % (source, os.getpid())
+        try:
+            try:
+                shutil.copyfile(source, copy)
+                connection.settings_dict['NAME'] = copy
+                result = measure(func, ctx, repeat)
+            except Exception:
+                result = {'error': traceback.format_exc()}
+            with os.fdopen(write_fd, 'w') as f:
+                f.write(json.dumps(result))
+        finally:
+            if os.path.exists(copy):
+                os.remove(copy)
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        output = f.read()
+    os.waitpid(pid, 0)
+    if not output:
+        return {'error': 'the benchmark process died'}
+    return json.loads(output)
+
+
+def check_budgets(results, budgets, tolerance=0.2):
+    '''
+    The regressions of results against budgets, as messages. Query counts
+    must stay within their budget, times and memory within budget *
+    (1 + tolerance); a case that failed or has no result is a regression.
+    '''
+    failures = []
+    for name in sorted(set(results) | set(budgets)):
+        result = results.get(name)
+        if result is None:
+            failures.append('%s: not run' % name)
+            continue
+        if 'error' in result:
+            failures.append('%s: %s' % (name, result['error']))
+            continue
+        for key, limit in sorted(budgets.get(name, {}).items()):
+            value = result.get(key)
+            if value is None:
+                continue
+            allowed = key.endswith('queries') and limit or \
+                limit * (1 + tolerance)
+            if value > allowed:
+                failures.append('%s: %s is %s, budget %s'
+                                % (name, key, value, limit))
+    return failures
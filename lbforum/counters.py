@@ -0,0 +1,273 @@
+# -*- coding: UTF-8 -*-
+"""
+Buffered Topic.num_views and LBForumUserProfile.last_activity.
+
+Views are counted with cache.incr on a per topic key and written to the
+database in batches by flush_topic_views, either from the
+lbforum_flush_topic_views command or, every LBF_VIEW_COUNT_FLUSH_INTERVAL
+seconds, by the request that happens to take the flush lock.
+
+A topic whose counter goes from 0 to 1 is appended to a journal (a sequence
+number plus one key per entry), so the flush knows which counters to read
+without scanning the cache. Topic listings wrap their topics in a
+LiveViewsList, which adds the pending views of a whole page of topics with
+one cache round trip.
+
+The last activity of a user is coalesced the same way: every request of a
+logged-in user overwrites a per user timestamp in the cache, and
+flush_user_activity writes the buffered timestamps in batches of users,
+one UPDATE per distinct timestamp, at most every
+LBF_ACTIVITY_FLUSH_INTERVAL seconds. The stored last_activity is therefore
+no staler than the interval (or than the cron running
+lbforum_flush_user_activity); get_user_activity reads through the buffer.
+"""
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from lbforum.models import Topic, LBForumUserProfile
+import settings as lbf_settings
+
+VIEWS = 'topic-views'
+ACTIVITY = 'user-activity'
+
+# users per UPDATE statement of flush_user_activity
+ACTIVITY_BATCH_SIZE = 500
+
+
+def _views_key(topic_id):
+    return '{0}-topic-views'.format(topic_id)
+
+
+def _activity_key(user_id):
+    return '{0}-user-activity'.format(user_id)
+
+
+def _dirty_key(user_id):
+    return '{0}-user-activity-dirty'.format(user_id)
+
+
+def _seq_key(name):
+    return '{0}-seq'.format(name)
+
+
+def _flushed_seq_key(name):
+    return '{0}-flushed-seq'.format(name)
+
+
+def _flush_lock_key(name):
+    return '{0}-flush-lock'.format(name)
+
+
+def _journal_key(name, seq):
+    return '{0}-journal-{1}'.format(name, seq)
+
+
+def _incr(key, timeout):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        if cache.add(key, 1, timeout):
+            return 1
+        return cache.incr(key)
+
+
+def _journal(name, obj_id, timeout):
+    seq = _incr(_seq_key(name), timeout)
+    cache.set(_journal_key(name, seq), obj_id, timeout)
+
+
+def _read_journal(name):
+    '''
+    The ids journaled since the last flush, and the keys of their entries.
+    '''
+    seq = cache.get(_seq_key(name), 0)
+    flushed_seq = cache.get(_flushed_seq_key(name), 0)
+    if flushed_seq > seq:
+        # the sequence key was evicted, start over
+        flushed_seq = 0
+    journal_keys = [_journal_key(name, e)
+                    for e in range(flushed_seq + 1, seq + 1)]
+    return set(cache.get_many(journal_keys).values()), seq, journal_keys
+
+
+def _end_flush(name, seq, journal_keys, timeout):
+    cache.set(_flushed_seq_key(name), seq, timeout)
+    cache.delete_many(journal_keys)
+
+
+def _should_flush(name, interval):
+    return interval and cache.add(_flush_lock_key(name), 1, interval)
+
+
+def incr_topic_views(topic_id):
+    '''
+    Count one view of a topic in the buffer.
+    '''
+    timeout = lbf_settings.VIEW_COUNT_TIMEOUT
+    if _incr(_views_key(topic_id), timeout) == 1:
+        _journal(VIEWS, topic_id, timeout)
+    if _should_flush(VIEWS, lbf_settings.VIEW_COUNT_FLUSH_INTERVAL):
+        flush_topic_views()
+
+
+def get_pending_views(topic_ids):
+    '''
+    Views buffered but not yet flushed, as a ``{topic_id: count}`` dict.
+    '''
+    keys = dict((_views_key(e), e) for e in topic_ids)
+    pending = cache.get_many(keys.keys())
+    return dict((keys[k], v) for k, v in pending.items() if v)
+
+
+def get_topic_views(topic):
+    '''
+    Live view count: the stored Topic.num_views plus the pending buffer.
+    '''
+    return topic.num_views + get_pending_views([topic.pk]).get(topic.pk, 0)
+
+
+def set_live_views(topics):
+    '''
+    Set live_num_views, the live view count, on a list of topics from one
+    cache round trip; returns the list.
+    '''
+    pending = get_pending_views([e.pk for e in topics])
+    for topic in topics:
+        topic.live_num_views = topic.num_views + pending.get(topic.pk, 0)
+    return topics
+
+
+class LiveViewsList(object):
+    '''
+    Wraps a list of topics (a QuerySet, a TopicIdList) for a paginator: the
+    topics of the page it slices get their live_num_views with one cache
+    round trip for the whole page.
+    '''
+
+    def __init__(self, topics):
+        self.topics = topics
+
+    def count(self):
+        try:
+            return self.topics.count()
+        except (AttributeError, TypeError):
+            return len(self.topics)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        return set_live_views(list(self.topics[index]))
+
+    def __iter__(self):
+        return iter(set_live_views(list(self.topics)))
+
+
+def flush_topic_views():
+    '''
+    Write the buffered views to Topic.num_views, one UPDATE per distinct
+    delta, and return the number of topics updated.
+    '''
+    timeout = lbf_settings.VIEW_COUNT_TIMEOUT
+    topic_ids, seq, journal_keys = _read_journal(VIEWS)
+    pending = get_pending_views(topic_ids)
+    topics_by_delta = defaultdict(list)
+    for topic_id, delta in pending.items():
+        topics_by_delta[delta].append(topic_id)
+    for delta, ids in topics_by_delta.items():
+        Topic.objects.filter(pk__in=ids).update(
+            num_views=F('num_views') + delta)
+    _end_flush(VIEWS, seq, journal_keys, timeout)
+    for topic_id, delta in pending.items():
+        # decr instead of delete keeps the views counted meanwhile, and those
+        # need a journal entry of their own for the next flush
+        try:
+            remaining = cache.decr(_views_key(topic_id), delta)
+        except ValueError:
+            continue
+        if remaining > 0:
+            _journal(VIEWS, topic_id, timeout)
+    return len(pending)
+
+
+def touch_user_activity(user_id, when):
+    '''
+    Buffer the last activity of a user, overwriting the buffered one.
+    '''
+    timeout = lbf_settings.ACTIVITY_TIMEOUT
+    cache.set(_activity_key(user_id), when, timeout)
+    # journal the user once until the next flush clears the dirty mark
+    if cache.add(_dirty_key(user_id), 1, timeout):
+        _journal(ACTIVITY, user_id, timeout)
+    if _should_flush(ACTIVITY, lbf_settings.ACTIVITY_FLUSH_INTERVAL):
+        flush_user_activity()
+
+
+def get_pending_activity(user_ids):
+    '''
+    Buffered last activities, as a ``{user_id: datetime}`` dict.
+    '''
+    keys = dict((_activity_key(e), e) for e in user_ids)
+    pending = cache.get_many(keys.keys())
+    return dict((keys[k], v) for k, v in pending.items() if v)
+
+
+def get_user_activity(profile):
+    '''
+    Live last activity: the buffered one if newer than the stored one.
+    '''
+    pending = get_pending_activity([profile.user_id]).get(profile.user_id)
+    if pending and pending > profile.last_activity:
+        return pending
+    return profile.last_activity
+
+
+def _update_last_activity(activity):
+    # one UPDATE per distinct timestamp, QuerySet.update sets one value; a
+    # CASE of parameters would be typed as text by PostgreSQL
+    users_by_time = defaultdict(list)
+    for user_id, when in activity.items():
+        users_by_time[when].append(user_id)
+    for when, user_ids in users_by_time.items():
+        LBForumUserProfile.objects.filter(user__in=user_ids).update(
+            last_activity=when)
+
+
+@transaction.commit_on_success
+def _write_activity(activity):
+    user_ids = list(activity)
+    existing = set(LBForumUserProfile.objects.filter(
+        user__in=user_ids).values_list('user', flat=True))
+    # what get_or_create did for users created before the profiles
+    LBForumUserProfile.objects.bulk_create(
+        [LBForumUserProfile(user_id=e) for e in user_ids
+         if e not in existing])
+    _update_last_activity(activity)
+
+
+def flush_user_activity():
+    '''
+    Write the buffered last activities to LBForumUserProfile.last_activity
+    and return the number of users updated.
+    '''
+    timeout = lbf_settings.ACTIVITY_TIMEOUT
+    user_ids, seq, journal_keys = _read_journal(ACTIVITY)
+    # unmark first: a user active from now on is journaled again, at worst
+    # written twice, never missed
+    cache.delete_many([_dirty_key(e) for e in user_ids])
+    activity = get_pending_activity(user_ids)
+    batch = {}
+    for user_id, when in activity.items():
+        batch[user_id] = when
+        if len(batch) == ACTIVITY_BATCH_SIZE:
+            _write_activity(batch)
+            batch = {}
+    if batch:
+        _write_activity(batch)
+    _end_flush(ACTIVITY, seq, journal_keys, timeout)
+    return len(activity)
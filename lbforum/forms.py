@@ -8,6 +8,8 @@ from django.utils.translation import ugettext_lazy as _
 from models import Topic, Post
 from models import LBForumUserProfile
 from lbforum.models import ForumFile
+from lbforum.render import invalidate_post_render, store_rendering
+from lbforum import objcache
 
 FORUM_ORDER_BY_CHOICES = (
     ('-last_reply_on', _('Last Reply')),
@@ -55,15 +57,21 @@ class EditPostForm(PostForm):
 
     def save(self):
         post = self.instance
+        invalidate_post_render(post)
         post.message = self.cleaned_data['message']
         post.updated_on = datetime.now()
         post.edited_by = self.user.username
+        if post.topic_post:
+            # set before the post is saved, the search index reads it
+            post.topic.subject = self.cleaned_data['subject']
         attachments = self.cleaned_data['attachments']
         post.update_attachments(attachments)
+        store_rendering(post)
         post.save()
         if post.topic_post:
-            post.topic.subject = self.cleaned_data['subject']
-            post.topic.save()
+            Topic._base_manager.filter(pk=post.topic_id).update(
+                subject=post.topic.subject)
+            objcache.invalidate(Topic, post.topic_id)
         return post
 
 
@@ -86,10 +94,14 @@ class NewPostForm(PostForm):
             topic = self.topic
         post = Post(topic=topic, posted_by=self.user, poster_ip=self.ip,
                     message=self.cleaned_data['message'], topic_post=topic_post)
+        store_rendering(post)
         post.save()
         if topic_post:
+            # only write the column, topic.save() would overwrite the
+            # counters the post_save handlers just incremented
             topic.post = post
-            topic.save()
+            Topic._base_manager.filter(pk=topic.pk).update(post=post)
+            objcache.invalidate(Topic, topic.pk)
         attachments = self.cleaned_data['attachments']
         post.update_attachments(attachments)
         return post
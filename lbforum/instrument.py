@@ -0,0 +1,312 @@
+# -*- coding: UTF-8 -*-
+"""
+Per-request instrumentation of the forum.
+
+While a Recorder is active in a thread it collects:
+
+- the number and total time of the SQL queries (from connection.queries,
+  the debug cursor is switched on for the duration);
+- the time spent in _postmarkup, clean_html and template rendering, with
+  the number of calls (nested calls are counted in both, a [html] block is
+  inside a _postmarkup call);
+- the cache hits and misses of the view helpers (objcache, render cache,
+  group and visible forums lookups, latest topics, site stats).
+
+InstrumentMiddleware records every request when LBF_INSTRUMENT is on, the
+instrument() context manager records any block of code. A finished
+recording can be sent as a Server-Timing header, logged as a JSON line on
+the lbforum.instrument logger, and added to per-view histograms kept in
+the cache, which the lbforum_instrument_stats command prints.
+
+With LBF_INSTRUMENT off the middleware removes itself, and the hooks in
+the helpers cost one thread-local lookup.
+"""
+import functools
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+import settings as lbf_settings
+
+logger = logging.getLogger('lbforum.instrument')
+
+_local = threading.local()
+
+TIMERS = ('postmarkup', 'clean_html', 'template')
+
+# upper bounds of the histogram buckets, the last one is open
+MS_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+HISTOGRAMS = (
+    ('total_ms', MS_BUCKETS),
+    ('sql_ms', MS_BUCKETS),
+    ('queries', COUNT_BUCKETS),
+    ('postmarkup_ms', MS_BUCKETS),
+    ('clean_html_ms', MS_BUCKETS),
+    ('template_ms', MS_BUCKETS),
+)
+_VIEWS_KEY = 'instrument-views'
+
+
+class Recorder(object):
+
+    def __init__(self, name=None):
+        self.name = name
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.cache = defaultdict(lambda: [0, 0])  # name: [hits, misses]
+        self.num_queries = 0
+        self.query_time = 0.0
+        self.total_time = 0.0
+        self._start = None
+        self._connections = []
+        self._previous = None
+
+    def start(self):
+        self._previous = getattr(_local, 'recorder', None)
+        _local.recorder = self
+        for conn in connections.all():
+            self._connections.append((conn, conn.use_debug_cursor,
+                                      len(conn.queries)))
+            conn.use_debug_cursor = True
+        self._start = time.time()
+        return self
+
+    def stop(self):
+        if self._start is None:
+            return self
+        self.total_time = time.time() - self._start
+        self._start = None
+        for conn, use_debug_cursor, first in self._connections:
+            queries = conn.queries[first:]
+            self.num_queries += len(queries)
+            self.query_time += sum(float(e['time']) for e in queries)
+            conn.use_debug_cursor = use_debug_cursor
+        self._connections = []
+        _local.recorder = self._previous
+        return self
+
+    def as_dict(self):
+        data = {
+            'name': self.name,
+            'total_ms': self.total_time * 1000,
+            'queries': self.num_queries,
+            'sql_ms': self.query_time * 1000,
+            'cache': dict((k, {'hits': v[0], 'misses': v[1]})
+                          for k, v in self.cache.items()),
+        }
+        for timer in TIMERS:
+            data['%s_ms' % timer] = self.times[timer] * 1000
+            data['%s_calls' % timer] = self.calls[timer]
+        return data
+
+    def server_timing(self):
+        '''
+        The value of a Server-Timing header.
+        '''
+        hits = sum(e[0] for e in self.cache.values())
+        misses = sum(e[1] for e in self.cache.values())
+        metrics = ['total;dur=%.1f' % (self.total_time * 1000),
+                   'sql;dur=%.1f;desc="%s queries"' % (self.query_time * 1000,
+                                                       self.num_queries)]
+        for timer in TIMERS:
+            metrics.append('%s;dur=%.1f;desc="%s calls"'
+                           % (timer.replace('_', '-'),
+                              self.times[timer] * 1000, self.calls[timer]))
+        metrics.append('cache;desc="%s hits, %s misses"' % (hits, misses))
+        return ', '.join(metrics)
+
+
+def current():
+    return getattr(_local, 'recorder', None)
+
+
+def timed(name):
+    '''
+    Decorator adding the time of each call of a callable to the name timer
+    of the active recorder.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            recorder = getattr(_local, 'recorder', None)
+            if recorder is None:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                recorder.times[name] += time.time() - start
+                recorder.calls[name] += 1
+        return wrapper
+    return decorator
+
+
+def cache_lookup(name, hit):
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is not None:
+        recorder.cache[name][not hit] += 1
+
+
+def cache_lookups(name, hits, misses):
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is not None:
+        counts = recorder.cache[name]
+        counts[0] += hits
+        counts[1] += misses
+
+
+_template_hook_lock = threading.Lock()
+
+
+def install_template_hook():
+    '''
+    Time Template.render for the active recorder; only the outermost
+    template of a nesting ({% include %}, inclusion tags) is counted.
+    '''
+    from django.template.base import Template
+    with _template_hook_lock:
+        if getattr(Template.render, '_lbforum_timed', False):
+            return
+        render = Template.render
+
+        def timed_render(self, context):
+            recorder = getattr(_local, 'recorder', None)
+            if recorder is None or getattr(recorder, '_in_template', False):
+                return render(self, context)
+            recorder._in_template = True
+            start = time.time()
+            try:
+                return render(self, context)
+            finally:
+                recorder._in_template = False
+                recorder.times['template'] += time.time() - start
+                recorder.calls['template'] += 1
+        timed_render._lbforum_timed = True
+        Template.render = timed_render
+
+
+def _histogram_key(name, metric, bucket):
+    return 'instrument-{0}-{1}-{2}'.format(name, metric, bucket)
+
+
+def _bucket(value, bounds):
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            return i
+    return len(bounds)
+
+
+def _incr(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, lbf_settings.INSTRUMENT_TIMEOUT):
+            cache.incr(key)
+
+
+def add_to_histograms(recorder):
+    '''
+    Count a finished recording in the histograms of its name.
+    '''
+    data = recorder.as_dict()
+    views = cache.get(_VIEWS_KEY) or []
+    if recorder.name not in views:
+        # a name added by another process meanwhile may be lost, it's
+        # added again by its next recording
+        cache.set(_VIEWS_KEY, sorted(views + [recorder.name]),
+                  lbf_settings.INSTRUMENT_TIMEOUT)
+    for metric, bounds in HISTOGRAMS:
+        _incr(_histogram_key(recorder.name, metric,
+                             _bucket(data[metric], bounds)))
+
+
+def get_histograms():
+    '''
+    ``{name: {metric: [count per bucket]}}``, see HISTOGRAMS for the bucket
+    bounds.
+    '''
+    histograms = {}
+    for name in cache.get(_VIEWS_KEY) or []:
+        keys = [(metric, i) for metric, bounds in HISTOGRAMS
+                for i in range(len(bounds) + 1)]
+        counts = cache.get_many([_histogram_key(name, m, i) for m, i in keys])
+        histograms[name] = dict(
+            (metric, [counts.get(_histogram_key(name, metric, i), 0)
+                      for i in range(len(bounds) + 1)])
+            for metric, bounds in HISTOGRAMS)
+    return histograms
+
+
+def reset_histograms():
+    for name in cache.get(_VIEWS_KEY) or []:
+        cache.delete_many([_histogram_key(name, metric, i)
+                           for metric, bounds in HISTOGRAMS
+                           for i in range(len(bounds) + 1)])
+    cache.delete(_VIEWS_KEY)
+
+
+def finish(recorder):
+    '''
+    Log a finished recording and add it to the histograms.
+    '''
+    if lbf_settings.INSTRUMENT_LOG:
+        logger.info(json.dumps(recorder.as_dict(), sort_keys=True))
+    if recorder.name and lbf_settings.INSTRUMENT_HISTOGRAMS:
+        add_to_histograms(recorder)
+
+
+@contextmanager
+def instrument(name=None):
+    '''
+    Record the block, yield the Recorder; with a name the recording is
+    logged and added to the histograms when the block ends.
+    '''
+    install_template_hook()
+    recorder = Recorder(name).start()
+    try:
+        yield recorder
+    finally:
+        recorder.stop()
+        if name:
+            finish(recorder)
+
+
+class InstrumentMiddleware(object):
+    """
+    Record each request, named after its view, see the module docstring.
+    """
+
+    def __init__(self):
+        if not lbf_settings.INSTRUMENT:
+            raise MiddlewareNotUsed
+        install_template_hook()
+
+    def process_request(self, request):
+        # named by process_view, requests that reach no view are only logged
+        request._lbforum_recorder = Recorder().start()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        recorder = getattr(request, '_lbforum_recorder', None)
+        if recorder is not None:
+            recorder.name = '%s.%s' % (view_func.__module__,
+                                       getattr(view_func, '__name__',
+                                               view_func.__class__.__name__))
+
+    def process_response(self, request, response):
+        recorder = getattr(request, '_lbforum_recorder', None)
+        if recorder is None:
+            return response
+        del request._lbforum_recorder
+        recorder.stop()
+        if lbf_settings.INSTRUMENT_HEADER:
+            response['Server-Timing'] = recorder.server_timing()
+        finish(recorder)
+        return response
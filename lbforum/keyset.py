@@ -0,0 +1,205 @@
+# -*- coding: UTF-8 -*-
+"""
+Keyset (seek) pagination.
+
+Instead of COUNT(*) + OFFSET, a page is fetched with a WHERE clause on the
+ordering columns of the last (or first) row of the page the user came from,
+so the cost of a page doesn't depend on how deep it is. The position is
+carried in opaque ``after``/``before`` tokens; plain ``?page=N`` urls keep
+working through a small OFFSET for the first LBF_KEYSET_PAGE_NUMBERS pages
+and 404 beyond.
+"""
+import base64
+import binascii
+import datetime
+import json
+
+from django.db import models
+from django.db.models import Q
+from django.http import Http404
+from django.utils.dateparse import parse_datetime
+
+import settings as lbf_settings
+
+
+def _reverse_ordering(ordering):
+    return [e[1:] if e.startswith('-') else '-' + e for e in ordering]
+
+
+def encode_token(values, offset):
+    '''
+    The token of the rows following values, the values of the ordering
+    columns; offset is the number of rows before them, for display.
+    '''
+    values = [e.isoformat() if isinstance(e, datetime.datetime) else e
+              for e in values]
+    data = json.dumps([values, offset])
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+class KeysetPaginator(object):
+    '''
+    :param queryset: The queryset to paginate
+    :param ordering: Ordering of the listing, ending with a unique column,
+    e.g. ``('-sticky', '-last_reply_on', '-id')``
+    :param per_page: Number of objects per page
+    :param count: Total number of objects when known without a COUNT query
+    (e.g. Forum.num_topics); only used for display
+    '''
+
+    def __init__(self, queryset, ordering, per_page, count=None):
+        self.queryset = queryset
+        self.ordering = list(ordering)
+        self.fields = [e.lstrip('-') for e in self.ordering]
+        self.per_page = per_page
+        self.count = count
+
+    @property
+    def num_pages(self):
+        if not self.count:
+            return 1
+        return (self.count - 1) // self.per_page + 1
+
+    @property
+    def page_range(self):
+        num_pages = min(self.num_pages, lbf_settings.KEYSET_PAGE_NUMBERS)
+        return range(1, num_pages + 1)
+
+    def encode_token(self, obj, offset):
+        return encode_token([getattr(obj, e) for e in self.fields], offset)
+
+    def decode_token(self, token):
+        try:
+            token = str(token)
+            data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+            values, offset = json.loads(data)
+            if len(values) != len(self.fields):
+                raise ValueError
+            for i, name in enumerate(self.fields):
+                field = self.queryset.model._meta.get_field(name)
+                if isinstance(field, models.DateTimeField):
+                    values[i] = parse_datetime(values[i])
+                if values[i] is None:
+                    raise ValueError
+            return values, int(offset)
+        except (TypeError, ValueError, binascii.Error,
+                models.FieldDoesNotExist):
+            raise Http404
+
+    def _seek(self, values, forward):
+        # (a, b, c) after (x, y, z) <=>
+        #   a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+        q = None
+        equal = {}
+        for field, name, value in zip(self.ordering, self.fields, values):
+            lookup = 'lt' if field.startswith('-') == forward else 'gt'
+            cond = dict(equal)
+            cond['%s__%s' % (name, lookup)] = value
+            q = Q(**cond) if q is None else q | Q(**cond)
+            equal[name] = value
+        return self.queryset.filter(q)
+
+    def page(self, request):
+        after = request.GET.get('after')
+        before = request.GET.get('before')
+        limit = self.per_page + 1
+        if after:
+            values, offset = self.decode_token(after)
+            qs = self._seek(values, True).order_by(*self.ordering)
+            object_list = list(qs[:limit])
+            has_next = len(object_list) > self.per_page
+            has_previous = True
+            object_list = object_list[:self.per_page]
+        elif before:
+            values, offset = self.decode_token(before)
+            qs = self._seek(values, False).order_by(
+                *_reverse_ordering(self.ordering))
+            object_list = list(qs[:limit])
+            has_previous = len(object_list) > self.per_page
+            has_next = True
+            object_list = object_list[:self.per_page]
+            object_list.reverse()
+            offset = max(offset - len(object_list), 0) if has_previous else 0
+        else:
+            try:
+                number = max(int(request.GET.get('page', 1)), 1)
+            except ValueError:
+                number = 1
+            if number > lbf_settings.KEYSET_PAGE_NUMBERS:
+                # the deep pages are only reached through tokens, by seeking
+                raise Http404
+            offset = (number - 1) * self.per_page
+            qs = self.queryset.order_by(*self.ordering)
+            object_list = list(qs[offset:offset + limit])
+            has_next = len(object_list) > self.per_page
+            has_previous = number > 1
+            object_list = object_list[:self.per_page]
+        if not object_list and (after or before):
+            raise Http404
+        return KeysetPage(self, object_list, offset, has_next, has_previous,
+                          request)
+
+
+class KeysetPage(object):
+    '''
+    One page of a KeysetPaginator. Quacks enough like django's Page for the
+    page_range_info/page_item_idx tags.
+    '''
+
+    def __init__(self, paginator, object_list, offset, has_next,
+                 has_previous, request):
+        self.paginator = paginator
+        self.object_list = object_list
+        self.offset = offset
+        self._has_next = has_next
+        self._has_previous = has_previous
+        self.request = request
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    @property
+    def number(self):
+        return self.offset // self.paginator.per_page + 1
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    def start_index(self):
+        if not self.object_list:
+            return 0
+        return self.offset + 1
+
+    def end_index(self):
+        return self.offset + len(self.object_list)
+
+    def _query(self, **kwargs):
+        getvars = self.request.GET.copy()
+        for k in ('page', 'after', 'before'):
+            getvars.pop(k, None)
+        getvars.update(kwargs)
+        return '?' + getvars.urlencode()
+
+    def next_query(self):
+        token = self.paginator.encode_token(self.object_list[-1],
+                                            self.end_index())
+        return self._query(after=token)
+
+    def previous_query(self):
+        if self.offset <= self.paginator.per_page:
+            return self._query(page=1)
+        token = self.paginator.encode_token(self.object_list[0], self.offset)
+        return self._query(before=token)
+
+    def page_queries(self):
+        return [(number, self._query(page=number))
+                for number in self.paginator.page_range]
@@ -0,0 +1,194 @@
+# -*- coding: UTF-8 -*-
+"""
+Cached "latest topics" of each forum.
+
+Every forum has a list of its LBF_LATEST_TOPICS_NUM most recently replied
+topics (with their forum and author loaded) under one cache key. A new post
+moves its topic to the front of the list of its forum in place, so once a
+list is built it is read without any query; hiding, editing or deleting a
+topic just drops the list of its forum.
+
+The recent activity feed works the same way, but every forum has its own
+list of ``(last_reply_on, topic_id, forum_id)`` entries of its
+LBF_RECENT_TOPICS_NUM most recently replied topics. The feed of a user is
+the merge of the lists of the forums they may see, capped after the
+merge, so it's filtered by forum and paginated before any topic is loaded
+and a user restricted to a few forums still gets a full feed.
+
+The lists are rewritten with a plain get/set, two posts at the same instant
+may lose one of the moves; the list is rebuilt when it expires.
+"""
+from itertools import chain
+from operator import attrgetter
+
+from django.core.cache import cache
+
+import settings as lbf_settings
+import instrument
+
+def _latest_topics_key(forum_id):
+    return '{0}-latest-topics'.format(forum_id)
+
+
+def _recent_topics_key(forum_id):
+    return '{0}-recent-topics'.format(forum_id)
+
+
+def _forum_slug_key(slug):
+    return 'forum-slug-{0}'.format(slug)
+
+
+def _topics_queryset():
+    # models.py imports this module
+    from lbforum.models import Topic
+    return Topic.objects.select_related('forum', 'posted_by')
+
+
+def _build_latest_topics(forum_id):
+    topics = _topics_queryset().filter(forum=forum_id)
+    return list(topics.order_by('-last_reply_on')[:lbf_settings.LATEST_TOPICS_NUM])
+
+
+def get_forum_by_slug(slug):
+    '''
+    The forum with that slug, or None; cached until the forum changes.
+    '''
+    from lbforum.models import Forum
+    ck = _forum_slug_key(slug)
+    forum = cache.get(ck)
+    instrument.cache_lookup('forum_slug', forum is not None)
+    if forum is None:
+        try:
+            forum = Forum.objects.get(slug=slug)
+        except Forum.DoesNotExist:
+            forum = False
+        cache.set(ck, forum, lbf_settings.LATEST_TOPICS_TIMEOUT)
+    return forum or None
+
+
+def get_latest_topics(forum_id):
+    '''
+    The latest topics of a forum, most recently replied first.
+    '''
+    return get_latest_topics_many([forum_id])[forum_id]
+
+
+def get_latest_topics_many(forum_ids):
+    '''
+    ``{forum_id: latest topics}`` in one cache round trip, the lists that
+    aren't cached are built with one query per forum.
+    '''
+    keys = dict((_latest_topics_key(e), e) for e in forum_ids)
+    cached = cache.get_many(keys.keys())
+    latest = dict((keys[k], v) for k, v in cached.items())
+    instrument.cache_lookups('latest_topics', len(latest),
+                             len(forum_ids) - len(latest))
+    missing = {}
+    for forum_id in forum_ids:
+        if forum_id not in latest:
+            latest[forum_id] = _build_latest_topics(forum_id)
+            missing[_latest_topics_key(forum_id)] = latest[forum_id]
+    if missing:
+        cache.set_many(missing, lbf_settings.LATEST_TOPICS_TIMEOUT)
+    return latest
+
+
+def push_latest_topic(topic_id, forum_id):
+    '''
+    Move a topic that just got a post to the front of its forum's list.
+    '''
+    ck = _latest_topics_key(forum_id)
+    topics = cache.get(ck)
+    if topics is None:
+        return
+    queryset = _topics_queryset()
+    try:
+        topic = queryset.get(pk=topic_id)
+    except queryset.model.DoesNotExist:
+        # hidden
+        cache.delete(ck)
+        return
+    topics = [topic] + [e for e in topics if e.pk != topic.pk]
+    topics.sort(key=attrgetter('last_reply_on'), reverse=True)
+    cache.set(ck, topics[:lbf_settings.LATEST_TOPICS_NUM],
+              lbf_settings.LATEST_TOPICS_TIMEOUT)
+
+
+def invalidate_latest_topics(forum_id):
+    cache.delete(_latest_topics_key(forum_id))
+
+
+def invalidate_forum_slug(slug):
+    cache.delete(_forum_slug_key(slug))
+
+
+def _build_recent_topics(forum_id):
+    from lbforum.models import Topic
+    topics = Topic.objects.filter(forum=forum_id).order_by('-last_reply_on')
+    topics = topics.values_list('last_reply_on', 'id', 'forum_id')
+    return list(topics[:lbf_settings.RECENT_TOPICS_NUM])
+
+
+def get_recent_topics(forum_ids):
+    '''
+    The ``(last_reply_on, topic_id, forum_id)`` entries of the recent
+    activity feed of some forums, most recently replied first; the lists of
+    the forums are read in one cache round trip, the ones that aren't
+    cached are built with one query per forum.
+    '''
+    keys = dict((_recent_topics_key(e), e) for e in forum_ids)
+    cached = cache.get_many(keys.keys())
+    instrument.cache_lookups('recent_topics', len(cached),
+                             len(keys) - len(cached))
+    missing = {}
+    for key, forum_id in keys.items():
+        if key not in cached:
+            missing[key] = _build_recent_topics(forum_id)
+    if missing:
+        cache.set_many(missing, lbf_settings.LATEST_TOPICS_TIMEOUT)
+    entries = sorted(chain(*chain(cached.values(), missing.values())),
+                     reverse=True)
+    return entries[:lbf_settings.RECENT_TOPICS_NUM]
+
+
+def push_recent_topic(topic_id, forum_id, last_reply_on):
+    '''
+    Move a topic that just got a post to the front of its forum's feed.
+    '''
+    ck = _recent_topics_key(forum_id)
+    entries = cache.get(ck)
+    if entries is None:
+        return
+    entries = [e for e in entries if e[1] != topic_id]
+    entries.append((last_reply_on, topic_id, forum_id))
+    entries.sort(reverse=True)
+    cache.set(ck, entries[:lbf_settings.RECENT_TOPICS_NUM],
+              lbf_settings.LATEST_TOPICS_TIMEOUT)
+
+
+def invalidate_recent_topics(forum_id):
+    cache.delete(_recent_topics_key(forum_id))
+
+
+class TopicIdList(object):
+    '''
+    A list of topic ids that loads the topics, with their forum and author,
+    when it's sliced; hand it to a paginator and only the current page is
+    queried.
+    '''
+
+    def __init__(self, topic_ids):
+        self.topic_ids = topic_ids
+
+    def __len__(self):
+        return len(self.topic_ids)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        topic_ids = self.topic_ids[index]
+        topics = self.get_queryset().in_bulk(topic_ids)
+        return [topics[e] for e in topic_ids if e in topics]
+
+    def get_queryset(self):
+        return _topics_queryset()
@@ -0,0 +1,26 @@
+"""
+Helpers of the commands that walk a whole table in primary key chunks.
+"""
+from optparse import make_option
+
+CHUNK_OPTIONS = (
+    make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                help='Number of rows handled per transaction.'),
+    make_option('--after-id', type='int', dest='after_id', default=0,
+                help='Resume after the row with this id instead of '
+                     'starting over.'),
+)
+
+
+def pk_chunks(queryset, chunk_size, after_id=0):
+    '''
+    Yield the primary keys of queryset in ascending lists of chunk_size,
+    reading nothing but the keys of one chunk at a time.
+    '''
+    queryset = queryset.order_by('pk').values_list('pk', flat=True)
+    while True:
+        pks = list(queryset.filter(pk__gt=after_id)[:chunk_size])
+        if not pks:
+            return
+        yield pks
+        after_id = pks[-1]
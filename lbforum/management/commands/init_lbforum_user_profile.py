@@ -1,17 +1,32 @@
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
 
-from lbforum.models import LBForumUserProfile
+from lbforum.models import LBForumUserProfile, Post
+from lbforum.management.chunks import CHUNK_OPTIONS, pk_chunks
 from django.contrib.auth.models import User
 
 
 class Command(BaseCommand):
     help = "Init LBForumUserProfile"
+    option_list = BaseCommand.option_list + CHUNK_OPTIONS
     
     def handle(self, **options):
-        users = User.objects.all()
-        for o in users:
-            #LBForumUserProfile.objects.create(user=instance)
-            try:
-                o.lbforum_profile
-            except LBForumUserProfile.DoesNotExist:
-                LBForumUserProfile.objects.create(user=o)
+        num_users = num_created = 0
+        for user_ids in pk_chunks(User.objects.all(), options['chunk_size'],
+                                  options['after_id']):
+            first_id, last_id = user_ids[0], user_ids[-1]
+            has_profile = set(LBForumUserProfile.objects.filter(
+                user__range=(first_id, last_id)).values_list('user', flat=True))
+            missing = [e for e in user_ids if e not in has_profile]
+            num_posts = dict(Post.objects.filter(posted_by__in=missing).values(
+                'posted_by').annotate(n=Count('id')).order_by().values_list(
+                    'posted_by', 'n'))
+            with transaction.commit_on_success():
+                LBForumUserProfile.objects.bulk_create([
+                    LBForumUserProfile(user_id=e, num_posts=num_posts.get(e, 0))
+                    for e in missing])
+            num_users += len(user_ids)
+            num_created += len(missing)
+            self.stdout.write("Checked %s users, created %s profiles, "
+                              "last id %s.\n" % (num_users, num_created, last_id))
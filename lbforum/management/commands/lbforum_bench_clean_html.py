@@ -0,0 +1,61 @@
+import re
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lbforum.models import Post
+from lbforum.templatetags.helper import clean_html, clean_html_soup
+
+_RE_HTML_BLOCK = re.compile(r'\[html\](.*?)\[/html\]',
+                            re.IGNORECASE | re.DOTALL)
+
+
+def _best_time(func, fragments, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for fragment in fragments:
+            func(fragment)
+        elapsed = time.time() - start
+        best = best is None and elapsed or min(best, elapsed)
+    return best
+
+
+class Command(BaseCommand):
+    help = ("Time clean_html against the BeautifulSoup implementation it "
+            "replaced, on the [html] blocks and HTML posts of the database.")
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=5000,
+                    help='Number of latest posts the corpus is taken from.'),
+        make_option('--repeat', type='int', dest='repeat', default=3,
+                    help='Runs per implementation, the best one counts.'),
+    )
+
+    def handle(self, **options):
+        fragments = []
+        posts = Post.objects.order_by('-pk').values_list('format', 'message')
+        for format, message in posts[:options['limit']]:
+            if format == 'html':
+                fragments.append(message)
+            else:
+                fragments.extend(_RE_HTML_BLOCK.findall(message))
+        if not fragments:
+            raise CommandError("No [html] block or HTML post to clean.")
+        size = sum(len(e) for e in fragments)
+        self.stdout.write("%s fragments, %s characters.\n"
+                          % (len(fragments), size))
+        timings = []
+        for name, func in (('BeautifulSoup', clean_html_soup),
+                           ('clean_html', clean_html)):
+            elapsed = _best_time(func, fragments, options['repeat'])
+            timings.append(elapsed)
+            self.stdout.write("%-14s %8.3fs %10.1f KB/s\n"
+                              % (name, elapsed,
+                                 size / 1024.0 / max(elapsed, 1e-6)))
+        self.stdout.write("speedup: %.1fx\n"
+                          % (timings[0] / max(timings[1], 1e-6)))
+        differ = len([e for e in fragments
+                      if clean_html(e) != clean_html_soup(e)])
+        # quoting, escaping and implicit nesting are written differently
+        self.stdout.write("%s fragments serialized differently.\n" % differ)
@@ -0,0 +1,99 @@
+import json
+import os
+import tempfile
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from lbforum.benchmark import CASES, DEFAULT_SIZES
+from lbforum.benchmark import generate, run_isolated, check_budgets
+
+
+def _size_option(name):
+    return make_option('--%s' % name, type='int', dest=name,
+                       default=DEFAULT_SIZES[name],
+                       help='Number of %s to generate.' % name)
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the views, the BBCode render path and the maintenance "
+            "commands on a synthetic forum in a scratch SQLite database.")
+    option_list = BaseCommand.option_list + tuple(
+        _size_option(e) for e in sorted(DEFAULT_SIZES)) + (
+        make_option('--seed', type='int', dest='seed', default=0,
+                    help='Seed of the generated data.'),
+        make_option('--repeat', type='int', dest='repeat', default=3,
+                    help='Runs of each case after the cold one.'),
+        make_option('--cases', dest='cases', default='',
+                    help='Comma separated names of the cases to run.'),
+        make_option('--output', dest='output', default='',
+                    help='Write the JSON results to this file instead of '
+                         'stdout.'),
+        make_option('--budgets', dest='budgets', default='',
+                    help='JSON budgets to check the results against.'),
+        make_option('--tolerance', type='float', dest='tolerance',
+                    default=0.2,
+                    help='Allowed excess of time and memory over budget.'),
+        make_option('--save-budgets', dest='save_budgets', default='',
+                    help='Write the results as the budgets of later runs.'),
+    )
+
+    def handle(self, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("The benchmark runs on SQLite only.")
+        cases = CASES
+        if options['cases']:
+            names = options['cases'].split(',')
+            cases = [e for e in CASES if e[0] in names]
+        sizes = dict((e, options[e]) for e in DEFAULT_SIZES)
+        fd, path = tempfile.mkstemp(suffix='.sqlite3', prefix='lbforum-bench')
+        os.close(fd)
+        # the data goes to a file database of its own, never the real one
+        connection.settings_dict['TEST_NAME'] = path
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                   autoclobber=True)
+        results = {}
+        try:
+            self.stderr.write("Generating %s.\n" % ', '.join(
+                '%s %s' % (v, k) for k, v in sorted(sizes.items())))
+            ctx = generate(seed=options['seed'], **sizes)
+            for name, func in cases:
+                results[name] = run_isolated(func, ctx, options['repeat'])
+                result = results[name]
+                if 'error' in result:
+                    self.stderr.write("%-32s error\n" % name)
+                else:
+                    self.stderr.write(
+                        "%-32s %8.1fms %5s queries %8s kB\n"
+                        % (name, result['time'] * 1000, result['queries'],
+                           result['memory_kb']))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        output = json.dumps({'sizes': sizes, 'results': results},
+                            indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output + '\n')
+        if options['save_budgets']:
+            budgets = dict(
+                (name, dict((k, v) for k, v in result.items()
+                            if k in ('time', 'queries', 'cold_queries',
+                                     'memory_kb') and v is not None))
+                for name, result in results.items() if 'error' not in result)
+            with open(options['save_budgets'], 'w') as f:
+                f.write(json.dumps(budgets, indent=2, sort_keys=True))
+        if options['budgets']:
+            with open(options['budgets']) as f:
+                budgets = json.load(f)
+            budgets = dict((k, v) for k, v in budgets.items() if k in results)
+            failures = check_budgets(results, budgets, options['tolerance'])
+            if failures:
+                raise CommandError("Over budget:\n%s" % '\n'.join(failures))
+        else:
+            failed = [k for k, v in results.items() if 'error' in v]
+            if failed:
+                raise CommandError("Failed: %s\n%s" % (', '.join(failed),
+                    '\n'.join(results[e]['error'] for e in failed)))
@@ -0,0 +1,87 @@
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from lbforum.models import Topic, Post
+from lbforum.views import get_topic_posts
+
+
+def _first_pk(model):
+    pks = model._default_manager.order_by('pk').values_list('pk', flat=True)[:1]
+    return pks and pks[0] or 1
+
+
+def hot_queries():
+    '''
+    (name, queryset) of the queries the forum, topic, recent and user pages
+    run, with the ids of the first rows as sample parameters.
+    '''
+    topic = Topic(pk=_first_pk(Topic))
+    forum_id = Topic.objects.filter(pk=topic.pk).values_list(
+        'forum_id', flat=True)[:1]
+    forum_id = forum_id and forum_id[0] or 1
+    user_id = _first_pk(User)
+    return [
+        ('forum topics', Topic.objects.filter(forum=forum_id).order_by(
+            '-sticky', '-last_reply_on')[:20]),
+        ('forum latest topics', Topic.objects.filter(forum=forum_id).order_by(
+            '-last_reply_on')[:10]),
+        ('topic posts', get_topic_posts(topic)[:20]),
+        ('post position', Post.objects.filter(topic=topic.pk, position__gt=1)),
+        ('recent topics', Topic.objects.order_by('-last_reply_on').values_list(
+            'last_reply_on', 'id', 'forum_id')[:500]),
+        ('user topics', Topic.objects.filter(posted_by=user_id).order_by(
+            '-created_on')[:20]),
+        ('user posts', Post.objects.filter(posted_by=user_id).order_by(
+            '-created_on')[:20]),
+        ('has replied', Post.objects.filter(posted_by=user_id, topic=topic.pk)),
+    ]
+
+
+def explain(sql, params):
+    '''
+    Run EXPLAIN for a query, return (plan lines, sequential scan lines).
+    '''
+    cursor = connection.cursor()
+    vendor = connection.vendor
+    if vendor == 'sqlite':
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        lines = [row[-1] for row in cursor.fetchall()]
+        scans = [e for e in lines if e.startswith('SCAN') and 'INDEX' not in e]
+    elif vendor == 'mysql':
+        cursor.execute('EXPLAIN ' + sql, params)
+        columns = [e[0] for e in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        lines = ['%(table)s: type=%(type)s key=%(key)s %(Extra)s' % e
+                 for e in rows]
+        scans = [line for e, line in zip(rows, lines) if e['type'] == 'ALL']
+    else:
+        cursor.execute('EXPLAIN ' + sql, params)
+        lines = [row[0] for row in cursor.fetchall()]
+        scans = [e.strip() for e in lines if 'Seq Scan' in e]
+    return lines, scans
+
+
+class Command(BaseCommand):
+    help = "EXPLAIN the hot queries of the forum views and report sequential scans."
+    option_list = BaseCommand.option_list + (
+        make_option('--fail', action='store_true', dest='fail', default=False,
+                    help='Exit with an error when a query does a sequential scan.'),
+        make_option('--plans', action='store_true', dest='plans', default=False,
+                    help='Print the full plan of every query.'),
+    )
+
+    def handle(self, **options):
+        num_scans = 0
+        for name, queryset in hot_queries():
+            sql, params = queryset.query.sql_with_params()
+            lines, scans = explain(sql, params)
+            status = scans and 'SEQUENTIAL SCAN' or 'ok'
+            self.stdout.write("%s: %s\n" % (name, status))
+            for line in (options['plans'] and lines or scans):
+                self.stdout.write("    %s\n" % line)
+            num_scans += len(scans)
+        if num_scans and options['fail']:
+            raise CommandError("%s sequential scans." % num_scans)
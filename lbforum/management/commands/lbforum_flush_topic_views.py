@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from lbforum.counters import flush_topic_views
+
+
+class Command(BaseCommand):
+    help = "Write buffered topic views to Topic.num_views."
+
+    def handle(self, **options):
+        num_topics = flush_topic_views()
+        self.stdout.write("Flushed views of %s topics.\n" % num_topics)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from lbforum.counters import flush_user_activity
+
+
+class Command(BaseCommand):
+    help = "Write buffered user activity to LBForumUserProfile.last_activity."
+
+    def handle(self, **options):
+        num_users = flush_user_activity()
+        self.stdout.write("Flushed activity of %s users.\n" % num_users)
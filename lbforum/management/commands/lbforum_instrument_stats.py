@@ -0,0 +1,55 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from lbforum.instrument import HISTOGRAMS, get_histograms, reset_histograms
+
+
+def _percentile(counts, bounds, fraction):
+    '''
+    The upper bound of the bucket holding the fraction-th recording.
+    '''
+    total = sum(counts)
+    seen = 0
+    for i, count in enumerate(counts):
+        seen += count
+        if seen >= total * fraction:
+            return i < len(bounds) and '<=%s' % bounds[i] or \
+                '>%s' % bounds[-1]
+
+
+class Command(BaseCommand):
+    help = ("Print the per view histograms recorded by "
+            "lbforum.instrument.InstrumentMiddleware.")
+    option_list = BaseCommand.option_list + (
+        make_option('--json', action='store_true', dest='json',
+                    default=False,
+                    help='Dump the raw bucket counts as JSON.'),
+        make_option('--reset', action='store_true', dest='reset',
+                    default=False,
+                    help='Clear the histograms after printing them.'),
+    )
+
+    def handle(self, **options):
+        histograms = get_histograms()
+        if options['json']:
+            self.stdout.write(json.dumps({
+                'buckets': dict(HISTOGRAMS),
+                'histograms': histograms,
+            }, indent=2, sort_keys=True) + '\n')
+        else:
+            for name, metrics in sorted(histograms.items()):
+                self.stdout.write("%s (%s requests)\n"
+                                  % (name, sum(metrics['total_ms'])))
+                for metric, bounds in HISTOGRAMS:
+                    counts = metrics[metric]
+                    if not sum(counts):
+                        continue
+                    self.stdout.write(
+                        "    %-14s p50 %-8s p95 %-8s max %s\n"
+                        % (metric, _percentile(counts, bounds, 0.5),
+                           _percentile(counts, bounds, 0.95),
+                           _percentile(counts, bounds, 1)))
+        if options['reset']:
+            reset_histograms()
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from lbforum.models import Post, PostSearchTerm
+from lbforum.search import index_posts
+from lbforum.management.chunks import CHUNK_OPTIONS
+
+
+class Command(BaseCommand):
+    help = "Build the search index of every post, in chunks of posts."
+    option_list = BaseCommand.option_list + CHUNK_OPTIONS
+
+    def handle(self, **options):
+        chunk_size = options['chunk_size']
+        last_id = options['after_id']
+        table = connection.ops.quote_name(PostSearchTerm._meta.db_table)
+        cursor = connection.cursor()
+        # plain DELETEs, QuerySet.delete() would load the rows first
+        with transaction.commit_on_success():
+            cursor.execute('DELETE FROM %s WHERE post_id > %%s' % table,
+                           [last_id])
+        num_posts = 0
+        while True:
+            posts = Post.objects.filter(pk__gt=last_id).order_by('pk')
+            posts = list(posts.select_related('topic')[:chunk_size])
+            if not posts:
+                break
+            with transaction.commit_on_success():
+                index_posts(posts)
+            last_id = posts[-1].pk
+            num_posts += len(posts)
+            self.stdout.write("Indexed %s posts, last id %s.\n"
+                              % (num_posts, last_id))
+        self.stdout.write("Done.\n")
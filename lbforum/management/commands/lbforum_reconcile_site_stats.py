@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from lbforum.sitestats import reconcile_site_stats
+
+
+class Command(BaseCommand):
+    help = "Count the cached site statistics again, e.g. from a daily cron job."
+
+    def handle(self, **options):
+        stats = reconcile_site_stats()
+        for name in sorted(stats):
+            self.stdout.write("%s: %s\n" % (name, stats[name]))
@@ -1,14 +1,36 @@
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min
 
-from lbforum.models import Topic
+from lbforum.models import Topic, Post
+from lbforum.management.chunks import CHUNK_OPTIONS, pk_chunks
 
 
 class Command(BaseCommand):
     help = "update topic/post's base info."
+    option_list = BaseCommand.option_list + CHUNK_OPTIONS
 
     def handle(self, **options):
-        topics = Topic.objects.all()
-        for t in topics:
-            post = t.posts.order_by('created_on').all()[0]
-            t.post = post
-            t.save()
+        num_topics = num_updated = 0
+        for pks in pk_chunks(Topic._base_manager.all(),
+                             options['chunk_size'], options['after_id']):
+            first_id, last_id = pks[0], pks[-1]
+            # post ids grow with created_on, the first post has the lowest
+            first_posts = Post.objects.filter(
+                topic__range=(first_id, last_id)).values('topic').annotate(
+                    first_post=Min('id')).order_by()
+            first_posts = dict((e['topic'], e['first_post'])
+                               for e in first_posts)
+            topics = Topic._base_manager.filter(
+                pk__range=(first_id, last_id)).values_list('pk', 'post')
+            topics = list(topics)
+            changed = [(pk, first_posts[pk]) for pk, post_id in topics
+                       if pk in first_posts and post_id != first_posts[pk]]
+            # Django 1.4 has no bulk_update, the values differ per row
+            with transaction.commit_on_success():
+                for pk, post_id in changed:
+                    Topic._base_manager.filter(pk=pk).update(post=post_id)
+            num_topics += len(topics)
+            num_updated += len(changed)
+            self.stdout.write("Checked %s topics, updated %s, last id %s.\n"
+                              % (num_topics, num_updated, last_id))
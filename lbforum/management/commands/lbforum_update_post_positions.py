@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from lbforum.models import Post
+
+
+class Command(BaseCommand):
+    help = ("Recompute Post.position (the post's 1-based index in its topic), "
+            "for posts inserted without Post.save.")
+
+    def handle(self, **options):
+        posts = Post.objects.order_by('topic', 'created_on', 'id').values_list(
+            'id', 'topic', 'position')
+        topic_id = None
+        num_updated = 0
+        for pk, post_topic_id, position in posts.iterator():
+            if post_topic_id != topic_id:
+                topic_id = post_topic_id
+                idx = 0
+            idx += 1
+            if position != idx:
+                Post.objects.filter(pk=pk).update(position=idx)
+                num_updated += 1
+        self.stdout.write("Updated %s posts.\n" % num_updated)
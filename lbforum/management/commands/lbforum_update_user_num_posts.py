@@ -0,0 +1,29 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from lbforum.models import LBForumUserProfile, Post
+
+CHUNK_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = "Rebuild LBForumUserProfile.num_posts from the post table."
+
+    @transaction.commit_on_success
+    def handle(self, **options):
+        counts = Post.objects.values('posted_by').annotate(
+            num_posts=Count('id')).order_by()
+        # group users by post count so each distinct count is one UPDATE
+        users_by_count = defaultdict(list)
+        for o in counts:
+            users_by_count[o['num_posts']].append(o['posted_by'])
+        LBForumUserProfile.objects.exclude(num_posts=0).update(num_posts=0)
+        for num_posts, user_ids in users_by_count.items():
+            for i in range(0, len(user_ids), CHUNK_SIZE):
+                LBForumUserProfile.objects.filter(
+                    user__in=user_ids[i:i + CHUNK_SIZE]).update(
+                        num_posts=num_posts)
+        self.stdout.write("Updated %s users.\n" % len(counts))
@@ -0,0 +1,65 @@
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from lbforum import latest, objcache, sitestats
+from lbforum.models import Forum, Topic
+from lbforum.rebuild import id_ranges, rebuild_topics, rebuild_forums
+
+
+def _rebuild_topics(id_range):
+    return rebuild_topics(*id_range)
+
+
+def _rebuild_forums(id_range):
+    return rebuild_forums(*id_range)
+
+
+class Command(BaseCommand):
+    help = ("Recompute the counters and last posts of every topic and forum, "
+            "id range by id range in a pool of processes.")
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes',
+                    default=cpu_count(),
+                    help='Number of worker processes, 1 to run inline.'),
+        make_option('--range-size', type='int', dest='range_size',
+                    default=10000,
+                    help='Number of ids recomputed per statement.'),
+    )
+
+    def _run(self, pool, func, ranges, name):
+        results = pool and pool.imap_unordered(func, ranges) or \
+            (func(e) for e in ranges)
+        for i, n in enumerate(results):
+            self.stdout.write("%s: %s/%s ranges done.\n"
+                              % (name, i + 1, len(ranges)))
+
+    def handle(self, **options):
+        topic_ranges = id_ranges(Topic, options['range_size'])
+        forum_ranges = id_ranges(Forum, options['range_size'])
+        pool = None
+        if options['processes'] > 1:
+            # the workers open their own connections, don't fork this one
+            connection.close()
+            pool = Pool(options['processes'])
+        try:
+            # forums sum the topics' num_replies, topics go first
+            self._run(pool, _rebuild_topics, topic_ranges, 'topics')
+            self._run(pool, _rebuild_forums, forum_ranges, 'forums')
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        sitestats.invalidate_categories_tree()
+        forum_ids = list(Forum.objects.values_list('id', flat=True))
+        for forum_id in forum_ids:
+            latest.invalidate_latest_topics(forum_id)
+            latest.invalidate_recent_topics(forum_id)
+        objcache.invalidate_many(Forum, forum_ids)
+        # the cached topics hold the counters just rebuilt too
+        for first_id, last_id in topic_ranges:
+            objcache.invalidate_many(Topic, Topic.objects.filter(
+                id__gte=first_id, id__lte=last_id).values_list('id', flat=True))
+        self.stdout.write("Done.\n")
@@ -0,0 +1,67 @@
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from lbforum import settings as lbf_settings
+from lbforum.models import Post
+from lbforum.rebuild import id_ranges
+from lbforum.render import store_rendering
+
+_RENDERED_FIELDS = ('rendered', 'rendered_noreply', 'rendered_hide_attachs',
+                    'rendered_version')
+
+
+@transaction.commit_on_success
+def _rerender(args):
+    first_id, last_id, rerender_all = args
+    posts = Post.objects.filter(pk__gte=first_id, pk__lte=last_id)
+    if not rerender_all:
+        posts = posts.exclude(rendered_version=lbf_settings.RENDER_VERSION)
+    num_posts = 0
+    for post in posts.only('id', 'message').order_by('pk').iterator():
+        store_rendering(post)
+        # only the rendered columns, without the post_save handlers
+        Post.objects.filter(pk=post.pk).update(
+            **dict((e, getattr(post, e)) for e in _RENDERED_FIELDS))
+        num_posts += 1
+    return num_posts
+
+
+class Command(BaseCommand):
+    help = ("Render the messages of the posts into their stored renderings, "
+            "id range by id range in a pool of processes.")
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes',
+                    default=cpu_count(),
+                    help='Number of worker processes, 1 to run inline.'),
+        make_option('--range-size', type='int', dest='range_size',
+                    default=1000,
+                    help='Number of post ids rendered per transaction.'),
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Render every post again, not only those rendered '
+                         'by an older LBF_RENDER_VERSION.'),
+    )
+
+    def handle(self, **options):
+        ranges = [(first_id, last_id, options['all']) for first_id, last_id
+                  in id_ranges(Post, options['range_size'])]
+        pool = None
+        if options['processes'] > 1:
+            # the workers open their own connections, don't fork this one
+            connection.close()
+            pool = Pool(options['processes'])
+        try:
+            results = pool and pool.imap_unordered(_rerender, ranges) or \
+                (_rerender(e) for e in ranges)
+            num_posts = 0
+            for i, n in enumerate(results):
+                num_posts += n
+                self.stdout.write("%s/%s ranges done, %s posts rendered.\n"
+                                  % (i + 1, len(ranges), num_posts))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        self.stdout.write("Done.\n")
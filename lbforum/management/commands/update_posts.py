@@ -1,12 +1,48 @@
 from django.core.management.base import BaseCommand
+from django.db import transaction
 
-from lbforum.models import Post
+from lbforum.models import Post, Topic
+from lbforum.management.chunks import CHUNK_OPTIONS, pk_chunks
+
+
+def _set_flag(queryset, flag, pks):
+    '''
+    Set flag on the rows of queryset whose pk is in pks and clear it on the
+    others, writing only the rows that change.
+    '''
+    queryset.filter(pk__in=pks, **{flag: False}).update(**{flag: True})
+    queryset.exclude(pk__in=pks).filter(**{flag: True}).update(**{flag: False})
 
 
 class Command(BaseCommand):
     help = "update topic/post's base info."
+    option_list = BaseCommand.option_list + CHUNK_OPTIONS
 
     def handle(self, **options):
-        posts = Post.objects.all()
-        for o in posts:
-            o.update_attachments_flag()
+        through = Post.attachments.through
+        num_posts = 0
+        for pks in pk_chunks(Post.objects.all(), options['chunk_size'],
+                             options['after_id']):
+            first_id, last_id = pks[0], pks[-1]
+            posts = Post.objects.filter(pk__range=(first_id, last_id))
+            attached = list(through.objects.filter(
+                post__range=(first_id, last_id)).values_list(
+                    'post', 'attachment__is_img').distinct())
+            with_attachments = set(pk for pk, is_img in attached if not is_img)
+            with_imgs = set(pk for pk, is_img in attached if is_img)
+            # a topic has the flags of its topic post
+            topic_posts = dict(posts.filter(topic_post=True).values_list(
+                'pk', 'topic'))
+            topics = Topic._base_manager.filter(pk__in=topic_posts.values())
+            with transaction.commit_on_success():
+                _set_flag(posts, 'has_attachments', with_attachments)
+                _set_flag(posts, 'has_imgs', with_imgs)
+                _set_flag(topics, 'has_attachments',
+                          [topic_posts[e] for e in with_attachments
+                           if e in topic_posts])
+                _set_flag(topics, 'has_imgs',
+                          [topic_posts[e] for e in with_imgs
+                           if e in topic_posts])
+            num_posts += len(pks)
+            self.stdout.write("Updated %s posts, last id %s.\n"
+                              % (num_posts, last_id))
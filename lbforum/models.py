@@ -1,13 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
-from base64 import b64encode, b64decode
-import pickle
-
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User,Group
-from django.db.models.signals import post_save
+from django.db.models.signals import post_init, post_save, post_delete
+from django.db.models.signals import m2m_changed
 from django.utils.translation import ugettext_lazy as _
-from django.db.models import Sum
+from django.db.models import Sum, F
 from django.conf import settings
 from django.core.cache import cache
 
@@ -15,6 +13,14 @@ from attachments.models import Attachment
 from onlineuser.models import Online
 from _sqlite3 import Cache
 
+import objcache
+import perms
+import sitestats
+import latest
+import search
+import keyset
+import settings as lbf_settings
+
 
 class Config(models.Model):
     key = models.CharField(max_length=255)  # PK
@@ -49,7 +55,10 @@ class Forum(models.Model):
     num_topics = models.IntegerField(default=0)
     num_posts = models.IntegerField(default=0)
 
-    last_post = models.CharField(max_length=255, blank=True)  # pickle obj
+    last_post_id = models.IntegerField(blank=True, null=True)
+    last_poster_id = models.IntegerField(blank=True, null=True)
+    last_poster_name = models.CharField(max_length=30, blank=True)
+    last_post_on = models.DateTimeField(blank=True, null=True)
 
     class Meta:
         verbose_name = _("Forum")
@@ -64,9 +73,22 @@ class Forum(models.Model):
         return num_posts['num_replies__sum'] or 0
 
     def get_last_post(self):
-        if not self.last_post:
+        if not self.last_post_id:
             return {}
-        return pickle.loads(b64decode(self.last_post))
+        return {'posted_by': self.last_poster_name,
+                'update': self.last_post_on}
+
+    def set_last_post(self, post):
+        self.last_post_id = post.pk
+        self.last_poster_id = post.posted_by_id
+        self.last_poster_name = post.posted_by.username
+        self.last_post_on = post.created_on
+
+    def clear_last_post(self):
+        self.last_post_id = None
+        self.last_poster_id = None
+        self.last_poster_name = ''
+        self.last_post_on = None
 
     @models.permalink
     def get_absolute_url(self):
@@ -81,16 +103,15 @@ class Forum(models.Model):
         if self.num_topics:
             last_post = Post.objects.all().filter(topic__forum=self)
             last_post = last_post.order_by('-created_on')[0]
-            self.last_post = gen_last_post_info(last_post)
+            self.set_last_post(last_post)
         else:
-            self.last_post = ''
+            self.clear_last_post()
         if commit:
             self.save()
 
     def save(self, force_insert=False, force_update=False, using=None):
         super(Forum,self).save(force_insert=force_insert,force_update=force_update,using=using)
-        if self.pk:
-            cache.delete('{0}-forum-groups'.format(self.pk))
+        perms.bump_generation(perms.FORUM)
         
         
 class TopicManager(models.Manager):
@@ -112,11 +133,16 @@ class Topic(models.Model):
                              related_name='topics_', blank=True, null=True)
     subject = models.CharField(max_length=999)
     num_views = models.IntegerField(default=0)
-    num_replies = models.PositiveSmallIntegerField(default=0)  # posts...
+    num_replies = models.PositiveIntegerField(default=0)  # posts...
+    # indexed with posted_by for the user's topics (see 0014)
     created_on = models.DateTimeField(auto_now_add=True)
     updated_on = models.DateTimeField(blank=True, null=True)
-    last_reply_on = models.DateTimeField(auto_now_add=True)
-    last_post = models.CharField(max_length=255, blank=True)  # pickle obj
+    # indexed alone for the recent feed and with forum, hidden and sticky for
+    # the forum listing (see 0014)
+    last_reply_on = models.DateTimeField(auto_now_add=True, db_index=True)
+    last_post_id = models.IntegerField(blank=True, null=True)
+    last_poster_id = models.IntegerField(blank=True, null=True)
+    last_poster_name = models.CharField(max_length=30, blank=True)
 
     has_imgs = models.BooleanField(default=False)
     has_attachments = models.BooleanField(default=False)
@@ -148,9 +174,16 @@ class Topic(models.Model):
         return ('lbforum_topic', (), {'topic_id': self.id})
 
     def get_last_post(self):
-        if not self.last_post:
+        if not self.last_post_id:
             return {}
-        return pickle.loads(b64decode(self.last_post))
+        return {'posted_by': self.last_poster_name,
+                'update': self.last_reply_on}
+
+    def set_last_post(self, post):
+        self.last_post_id = post.pk
+        self.last_poster_id = post.posted_by_id
+        self.last_poster_name = post.posted_by.username
+        self.last_reply_on = post.created_on
 
     def has_replied(self, user):
         if user.is_anonymous():
@@ -160,8 +193,7 @@ class Topic(models.Model):
     def update_state_info(self, commit=True):
         self.num_replies = self.count_nums_replies()
         last_post = self.posts.order_by('-created_on')[0]
-        self.last_post = gen_last_post_info(last_post)
-        self.save()
+        self.set_last_post(last_post)
         if commit:
             self.save()
 
@@ -179,14 +211,22 @@ class Post(models.Model):
 
     format = models.CharField(max_length=20, default='bbcode')  # user name
     message = models.TextField()
+    # message rendered when saved, see lbforum.render.store_rendering
+    rendered = models.TextField(blank=True)
+    rendered_noreply = models.TextField(blank=True)
+    rendered_hide_attachs = models.TextField(blank=True)
+    rendered_version = models.PositiveSmallIntegerField(default=0)
     attachments = models.ManyToManyField(Attachment, blank=True)
 
     has_imgs = models.BooleanField(default=False)
     has_attachments = models.BooleanField(default=False)
 
+    # indexed with topic and with posted_by (see 0014)
     created_on = models.DateTimeField(auto_now_add=True)
     updated_on = models.DateTimeField(blank=True, null=True)
     edited_by = models.CharField(max_length=255, blank=True)  # user name
+    # 1-based position in the topic, indexed together with topic (see 0010)
+    position = models.PositiveIntegerField(default=0)
 
     class Meta:
         verbose_name = _("Post")
@@ -197,26 +237,39 @@ class Post(models.Model):
     def __unicode__(self):
         return self.message[:80]
 
+    def save(self, force_insert=False, force_update=False, using=None):
+        if self.pk:
+            return super(Post, self).save(force_insert=force_insert,
+                                          force_update=force_update,
+                                          using=using)
+        # update_topic_on_post bumps the topic's num_replies and reads it back
+        # in the transaction of the insert, the row lock taken by its UPDATE
+        # gives concurrent replies to a topic one position each
+        with transaction.commit_on_success(using=using):
+            super(Post, self).save(force_insert=force_insert,
+                                   force_update=force_update, using=using)
+
     def subject(self):
         if self.topic_post:
             return _('Topic: %s') % self.topic.subject
         return _('Re: %s') % self.topic.subject
 
     def file_attachments(self):
-        return self.attachments.filter(is_img=False)
+        # split in python so prefetch_related('attachments') is reused
+        return [e for e in self.attachments.all() if not e.is_img]
 
     def img_attachments(self):
-        return self.attachments.filter(is_img=True)
+        return [e for e in self.attachments.all() if e.is_img]
 
     def update_attachments_flag(self):
-        self.has_attachments = self.file_attachments().count() > 0
-        self.has_imgs = self.img_attachments().count() > 0
+        self.has_attachments = self.attachments.filter(is_img=False).exists()
+        self.has_imgs = self.attachments.filter(is_img=True).exists()
         self.save()
         if self.topic_post:
-            t = self.topic
-            t.has_attachments = self.has_attachments
-            t.has_imgs = self.has_imgs
-            t.save()
+            # don't save the whole topic row, it would write back stale counters
+            Topic._base_manager.filter(pk=self.topic_id).update(
+                has_attachments=self.has_attachments, has_imgs=self.has_imgs)
+            objcache.invalidate(Topic, self.topic_id)
 
     def update_attachments(self, attachment_ids):
         self.attachments.clear()
@@ -236,10 +289,29 @@ class Post(models.Model):
 
     def get_absolute_url_ext(self):
         topic = self.topic
-        post_idx = topic.posts.filter(created_on__lte=self.created_on).count()
+        post_idx = self.position
+        if not post_idx:
+            # inserted without Post.save, see lbforum_update_post_positions
+            post_idx = topic.posts.filter(created_on__lte=self.created_on).count()
         page = (post_idx - 1) / settings.CTX_CONFIG['TOPIC_PAGE_SIZE'] + 1
+        if (lbf_settings.KEYSET_PAGINATION and
+                page > lbf_settings.KEYSET_PAGE_NUMBERS):
+            # only reachable by seeking, from just before the post
+            token = keyset.encode_token([self.created_on, self.pk - 1],
+                                        post_idx - 1)
+            return '%s?after=%s#p%s' % (topic.get_absolute_url(), token,
+                                        self.pk)
         return '%s?page=%s#p%s' % (topic.get_absolute_url(), page, self.pk)
 
+
+class PostSearchTerm(models.Model):
+    """A term of a post in the search index, see lbforum.search."""
+    # indexed with forum_id (see 0015)
+    term = models.CharField(max_length=40)
+    post_id = models.IntegerField(db_index=True)
+    forum_id = models.IntegerField()
+    weight = models.PositiveSmallIntegerField(default=1)
+
 class ForumFile(models.Model):
     title = models.CharField(max_length=100)
     file = models.FileField(upload_to='forum')
@@ -257,24 +329,41 @@ class LBForumUserProfile(models.Model):
     userrank = models.CharField(max_length=30, default="Junior Member")
     last_posttime = models.DateTimeField(auto_now_add=True)
     signature = models.CharField(max_length=1000, blank=True)
+    num_posts = models.IntegerField(default=0)
 
     def __unicode__(self):
         return self.user.username
 
     def get_total_posts(self):
-        return self.user.post_set.count()
+        return self.num_posts
+
+    def update_num_posts(self, commit=True):
+        self.num_posts = self.user.post_set.count()
+        if commit:
+            self.save()
 
     def get_absolute_url(self):
         return self.user.get_absolute_url()
 
 
 #### do smoe connect ###
-def gen_last_post_info(post):
-    last_post = {
-        'posted_by': post.posted_by.username,
-        'update': post.created_on
-    }
-    return b64encode(pickle.dumps(last_post, pickle.HIGHEST_PROTOCOL))
+# fields whose changes the handlers below act on, the values an instance
+# was loaded (or last saved) with are kept in its _loaded_values
+TRACKED_FIELDS = {
+    Forum: ('name', 'slug', 'ordering', 'category_id'),
+    Topic: ('hidden', 'forum_id'),
+}
+
+
+def remember_loaded_values(sender, instance, **kwargs):
+    # __dict__, a deferred field would be loaded by getattr
+    instance._loaded_values = dict((e, instance.__dict__.get(e))
+                                   for e in TRACKED_FIELDS[sender])
+
+
+def changed_fields(instance):
+    loaded = getattr(instance, '_loaded_values', {})
+    return set(k for k, v in loaded.items() if instance.__dict__.get(k) != v)
 
 
 def create_user_profile(sender, instance, created, **kwargs):
@@ -283,44 +372,226 @@ def create_user_profile(sender, instance, created, **kwargs):
 
 def clear_user_forum_cache(sender,instance,created,**kwargs):
     if not created:
-        cache.delete('{0}-user-groups'.format(instance.pk))
+        perms.invalidate_objs_groups(perms.USER, [instance.pk])
         
-def update_topic_on_post(sender, instance, created, **kwargs):
+def _last_post_values(post):
+    return {'last_post_id': post.pk,
+            'last_poster_id': post.posted_by_id,
+            'last_poster_name': post.posted_by.username}
+
+
+# The counters below are bumped with a single UPDATE ... SET n = n + 1 per
+# table, so concurrent posts don't lose increments. update_state_info is
+# only needed to repair them. Topic.num_replies also gives the post its
+# position.
+def update_topic_on_post(sender, instance, created, using=None, **kwargs):
     if created:
-        t = instance.topic
-        t.last_post = gen_last_post_info(instance)
-        t.last_reply_on = instance.created_on
-        t.num_replies += 1
-        t.save()
-        p = instance.posted_by.lbforum_profile
-        p.last_posttime = instance.created_on
-        p.save()
+        # connected first: one UPDATE of the topic row per post, taken before
+        # any other row lock of the post's transaction
+        topics = Topic._base_manager.using(using).filter(pk=instance.topic_id)
+        topics.update(num_replies=F('num_replies') + 1,
+                      last_reply_on=instance.created_on,
+                      **_last_post_values(instance))
+        if not instance.position:
+            instance.position = topics.values_list('num_replies',
+                                                   flat=True)[0]
+            Post._base_manager.using(using).filter(pk=instance.pk).update(
+                position=instance.position)
+        objcache.invalidate(Topic, instance.topic_id)
+        LBForumUserProfile.objects.filter(user=instance.posted_by_id).update(
+            num_posts=F('num_posts') + 1,
+            last_posttime=instance.created_on)
+
+
+def update_topic_on_post_delete(sender, instance, **kwargs):
+    Topic._base_manager.filter(pk=instance.topic_id, num_replies__gt=0).update(
+        num_replies=F('num_replies') - 1)
+    objcache.invalidate(Topic, instance.topic_id)
+
+
+def update_user_on_post_delete(sender, instance, **kwargs):
+    LBForumUserProfile.objects.filter(user=instance.posted_by_id).update(
+        num_posts=F('num_posts') - 1)
+
+
+def compact_post_positions(sender, instance, **kwargs):
+    if instance.position:
+        Post.objects.filter(topic=instance.topic_id,
+                            position__gt=instance.position).update(
+            position=F('position') - 1)
 
 
 def update_forum_on_post(sender, instance, created, **kwargs):
     if created:
-        instance.topic.forum.last_post = gen_last_post_info(instance)
-        instance.topic.forum.num_posts += 1
-        instance.topic.forum.save()
+        Forum.objects.filter(pk=instance.topic.forum_id).update(
+            num_posts=F('num_posts') + 1,
+            last_post_on=instance.created_on,
+            **_last_post_values(instance))
+        objcache.invalidate(Forum, instance.topic.forum_id)
 
 
 def update_forum_on_topic(sender, instance, created, **kwargs):
     if created:
-        instance.forum.num_topics += 1
-        instance.forum.save()
+        Forum.objects.filter(pk=instance.forum_id).update(
+            num_topics=F('num_topics') + 1)
+        objcache.invalidate(Forum, instance.forum_id)
 
 
-def update_user_last_activity(sender, instance, created, **kwargs):
-    if instance.user:
-        p, created = LBForumUserProfile.objects.get_or_create(
-            user=instance.user)
+def update_site_stats_on_post(sender, instance, created, **kwargs):
+    if created:
+        sitestats.incr_site_stat(sitestats.TOTAL_POSTS)
 
-        p.last_activity = instance.updated_on
-        p.save()
+
+def update_site_stats_on_post_delete(sender, instance, **kwargs):
+    sitestats.incr_site_stat(sitestats.TOTAL_POSTS, -1)
+
+
+def update_site_stats_on_topic(sender, instance, created, **kwargs):
+    if created:
+        if not instance.hidden:
+            sitestats.incr_site_stat(sitestats.TOTAL_TOPICS)
+    elif 'hidden' in changed_fields(instance):
+        # Topic.objects doesn't count the hidden topics
+        sitestats.incr_site_stat(sitestats.TOTAL_TOPICS,
+                                 instance.hidden and -1 or 1)
+
+
+def update_site_stats_on_topic_delete(sender, instance, **kwargs):
+    if not instance.hidden:
+        sitestats.incr_site_stat(sitestats.TOTAL_TOPICS, -1)
+
+
+def update_site_stats_on_user(sender, instance, created, **kwargs):
+    if created:
+        sitestats.incr_site_stat(sitestats.TOTAL_USERS)
+        sitestats.set_last_registered_user(instance)
+
+
+def update_site_stats_on_user_delete(sender, instance, **kwargs):
+    sitestats.incr_site_stat(sitestats.TOTAL_USERS, -1)
+    sitestats.invalidate_site_stat(sitestats.LAST_REGISTERED_USER)
+
+
+def update_latest_topics_on_post(sender, instance, created, **kwargs):
+    if created:
+        latest.push_latest_topic(instance.topic_id, instance.topic.forum_id)
+        if not instance.topic.hidden:
+            latest.push_recent_topic(instance.topic_id,
+                                     instance.topic.forum_id,
+                                     instance.created_on)
+
+
+def clear_latest_topics(sender, instance, **kwargs):
+    if not kwargs.get('created'):
+        latest.invalidate_latest_topics(instance.forum_id)
+        latest.invalidate_recent_topics(instance.forum_id)
+        if 'forum_id' in changed_fields(instance):
+            # moved, drop it from the lists of its previous forum too
+            forum_id = instance._loaded_values['forum_id']
+            latest.invalidate_latest_topics(forum_id)
+            latest.invalidate_recent_topics(forum_id)
+
+
+def clear_forum_slug(sender, instance, **kwargs):
+    latest.invalidate_forum_slug(instance.slug)
+    if 'slug' in changed_fields(instance):
+        # renamed, the old slug would serve the forum until it times out
+        latest.invalidate_forum_slug(instance._loaded_values['slug'])
+
+
+def update_search_index(sender, instance, **kwargs):
+    if not kwargs.get('raw'):  # loaddata, see lbforum_rebuild_search_index
+        search.index_post(instance)
+
+
+def remove_from_search_index(sender, instance, **kwargs):
+    search.unindex_posts([instance.pk])
+
+
+def move_search_index(sender, instance, created, **kwargs):
+    if not created and 'forum_id' in changed_fields(instance):
+        post_ids = Post.objects.filter(topic=instance).values('id')
+        PostSearchTerm.objects.filter(post_id__in=post_ids).exclude(
+            forum_id=instance.forum_id).update(forum_id=instance.forum_id)
+
+
+def clear_categories_tree(sender, **kwargs):
+    sitestats.invalidate_categories_tree()
+
+
+def clear_categories_tree_on_forum(sender, instance, created, **kwargs):
+    # the tree only shows the tracked fields
+    if created or changed_fields(instance):
+        sitestats.invalidate_categories_tree()
+
+
+def clear_forum_perms_cache(sender, **kwargs):
+    action = kwargs.get('action')  # only sent by m2m_changed
+    if action is None or action.startswith('post_'):
+        perms.bump_generation(perms.FORUM)
+
+
+def clear_group_perms_cache(sender, **kwargs):
+    # a renamed or deleted group changes the names cached for any number of
+    # forums and users
+    perms.bump_generation(perms.FORUM)
+    perms.bump_generation(perms.USER)
+
+
+def clear_user_groups_cache(sender, instance, action, reverse, pk_set,
+                            **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        perms.invalidate_objs_groups(perms.USER, [instance.pk])
+    elif pk_set:
+        perms.invalidate_objs_groups(perms.USER, pk_set)
+    else:
+        # group.user_set.clear() doesn't say which users it removed
+        perms.bump_generation(perms.USER)
+
+
+def update_user_last_activity(sender, instance, created, **kwargs):
+    # counters.py imports this module
+    from lbforum.counters import touch_user_activity
+    if instance.user_id:
+        touch_user_activity(instance.user_id, instance.updated_on)
 
 post_save.connect(clear_user_forum_cache,sender=User)
+m2m_changed.connect(clear_forum_perms_cache, sender=Forum.groups.through)
+m2m_changed.connect(clear_user_groups_cache, sender=User.groups.through)
+post_delete.connect(clear_forum_perms_cache, sender=Forum)
+post_save.connect(clear_group_perms_cache, sender=Group)
+post_delete.connect(clear_group_perms_cache, sender=Group)
 post_save.connect(create_user_profile, sender=User)
 post_save.connect(update_topic_on_post, sender=Post)
 post_save.connect(update_forum_on_post, sender=Post)
+post_delete.connect(update_topic_on_post_delete, sender=Post)
+post_delete.connect(update_user_on_post_delete, sender=Post)
+post_delete.connect(compact_post_positions, sender=Post)
 post_save.connect(update_forum_on_topic, sender=Topic)
 post_save.connect(update_user_last_activity, sender=Online)
+post_save.connect(update_site_stats_on_post, sender=Post)
+post_delete.connect(update_site_stats_on_post_delete, sender=Post)
+post_save.connect(update_site_stats_on_topic, sender=Topic)
+post_delete.connect(update_site_stats_on_topic_delete, sender=Topic)
+post_save.connect(update_site_stats_on_user, sender=User)
+post_delete.connect(update_site_stats_on_user_delete, sender=User)
+post_save.connect(update_latest_topics_on_post, sender=Post)
+post_save.connect(clear_latest_topics, sender=Topic)
+post_delete.connect(clear_latest_topics, sender=Topic)
+post_save.connect(clear_forum_slug, sender=Forum)
+post_delete.connect(clear_forum_slug, sender=Forum)
+post_save.connect(update_search_index, sender=Post)
+post_delete.connect(remove_from_search_index, sender=Post)
+post_save.connect(move_search_index, sender=Topic)
+post_save.connect(clear_categories_tree, sender=Category)
+post_save.connect(clear_categories_tree_on_forum, sender=Forum)
+for model in (Category, Forum):
+    post_delete.connect(clear_categories_tree, sender=model)
+for model in (Forum, Topic, Post, User):
+    objcache.register(model)
+for model in TRACKED_FIELDS:
+    post_init.connect(remember_loaded_values, sender=model)
+    # last, the handlers above compare with the values before the save
+    post_save.connect(remember_loaded_values, sender=model)
@@ -0,0 +1,156 @@
+# -*- coding: UTF-8 -*-
+"""
+Model instance cache.
+
+Instances are cached under keys namespaced by LBF_OBJ_CACHE_VERSION, the
+model and the primary key. Registered models are dropped from the cache by
+their post_save/post_delete signals; code that changes rows with
+QuerySet.update() has to call invalidate() itself.
+"""
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.http import Http404
+
+import settings as lbf_settings
+import instrument
+
+_stats = defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+
+def _model_label(model_class):
+    return '{0}.{1}'.format(model_class._meta.app_label,
+                            model_class._meta.object_name.lower())
+
+
+def _cache_key(model_class, pk):
+    return 'obj-{0}-{1}-{2}'.format(lbf_settings.OBJ_CACHE_VERSION,
+                                    _model_label(model_class), pk)
+
+
+def _to_pk(model_class, pk):
+    return model_class._meta.pk.to_python(pk)
+
+
+def get_cached_obj(model_class, pk, cache_timeout=None, get_or_404=True):
+    '''
+    Using a primary key retrieve an object from the cache or the database.
+    :param model_class: The Django model class to query if the object is
+    not in the cache
+    :param pk: Primary key
+    :param get_or_404: Raise Http404 instead of returning None when the
+    object doesn't exist
+    '''
+    if pk is None:
+        return None
+    try:
+        pk = _to_pk(model_class, pk)
+    except Exception:
+        if get_or_404:
+            raise Http404
+        return None
+    ck = _cache_key(model_class, pk)
+    stats = _stats[_model_label(model_class)]
+    obj = cache.get(ck)
+    instrument.cache_lookup('objcache', obj is not None)
+    if obj is not None:
+        stats['hits'] += 1
+        return obj
+    stats['misses'] += 1
+    try:
+        obj = model_class._default_manager.get(pk=pk)
+    except model_class.DoesNotExist:
+        if get_or_404:
+            raise Http404('No %s matches the given query.' %
+                          model_class._meta.object_name)
+        return None
+    cache.set(ck, obj, cache_timeout or lbf_settings.OBJ_CACHE_TIMEOUT)
+    return obj
+
+
+def _get_many(lookups, cache_timeout=None):
+    keys = dict((_cache_key(model_class, pk), (model_class, pk))
+                for model_class, pk in lookups)
+    if not keys:
+        return {}
+    objs = dict((keys[k], obj) for k, obj in cache.get_many(keys.keys()).items())
+    missing = defaultdict(list)
+    for model_class, pk in keys.values():
+        if (model_class, pk) in objs:
+            _stats[_model_label(model_class)]['hits'] += 1
+        else:
+            _stats[_model_label(model_class)]['misses'] += 1
+            missing[model_class].append(pk)
+    instrument.cache_lookups('objcache', len(objs), len(keys) - len(objs))
+    fetched = {}
+    for model_class, pks in missing.items():
+        for pk, obj in model_class._default_manager.in_bulk(pks).items():
+            objs[(model_class, pk)] = obj
+            fetched[_cache_key(model_class, pk)] = obj
+    if fetched:
+        cache.set_many(fetched, cache_timeout or lbf_settings.OBJ_CACHE_TIMEOUT)
+    return objs
+
+
+def get_many(model_class, pks, cache_timeout=None):
+    '''
+    Retrieve several objects of a model in one cache round trip, the misses
+    are loaded with one in_bulk query. Returns a ``{pk: obj}`` dict without
+    the pks that don't exist.
+    '''
+    pks = [_to_pk(model_class, pk) for pk in pks if pk is not None]
+    objs = _get_many([(model_class, pk) for pk in pks], cache_timeout)
+    return dict((pk, obj) for (model_class, pk), obj in objs.items())
+
+
+def get_objs(lookups, cache_timeout=None):
+    '''
+    Retrieve the objects of ``(model_class, pk)`` lookups of any models in
+    one cache round trip, the misses are loaded with one in_bulk query per
+    model. Returns the objects in the order of the lookups, None for a pk
+    that is None, invalid or doesn't exist.
+    '''
+    pks = []
+    for model_class, pk in lookups:
+        try:
+            pks.append(pk is not None and _to_pk(model_class, pk) or None)
+        except Exception:
+            pks.append(None)
+    objs = _get_many([(model_class, pk) for (model_class, e), pk
+                      in zip(lookups, pks) if pk is not None], cache_timeout)
+    return [objs.get((model_class, pk)) for (model_class, e), pk
+            in zip(lookups, pks)]
+
+
+def invalidate(model_class, pk):
+    cache.delete(_cache_key(model_class, _to_pk(model_class, pk)))
+
+
+def invalidate_many(model_class, pks):
+    cache.delete_many([_cache_key(model_class, _to_pk(model_class, e))
+                       for e in pks])
+
+
+def _invalidate_instance(sender, instance, **kwargs):
+    invalidate(sender, instance.pk)
+
+
+def register(model_class):
+    '''
+    Drop instances of model_class from the cache when they are saved or
+    deleted.
+    '''
+    uid = 'lbforum-objcache-%s' % _model_label(model_class)
+    post_save.connect(_invalidate_instance, sender=model_class,
+                      dispatch_uid=uid)
+    post_delete.connect(_invalidate_instance, sender=model_class,
+                        dispatch_uid=uid)
+
+
+def get_stats():
+    '''
+    Hit/miss counters per model (``'app_label.model'``) for the current
+    process.
+    '''
+    return dict((label, dict(stats)) for label, stats in _stats.items())
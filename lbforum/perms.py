@@ -0,0 +1,68 @@
+# -*- coding: UTF-8 -*-
+"""
+Cached group memberships of forums and users.
+
+The group names of a forum or a user are cached as a frozenset under a key
+holding a generation counter of its kind (``forum`` or ``user``). A change
+to one object deletes its entry; a change that can touch any number of
+them (a group renamed or deleted, ``group.user_set.clear()``) bumps the
+generation, which orphans every entry of that kind at once.
+
+The ``forum`` generation is also part of the key of the cached visible
+forums lookup, so anything that changes which forums a group can see bumps
+it.
+"""
+import time
+
+from django.core.cache import cache
+
+import settings as lbf_settings
+import instrument
+
+FORUM = 'forum'
+USER = 'user'
+
+
+def _generation_key(kind):
+    return 'perms-generation-{0}'.format(kind)
+
+
+def get_generation(kind):
+    key = _generation_key(kind)
+    generation = cache.get(key)
+    if generation is None:
+        # seed from the clock so an evicted generation never comes back
+        cache.add(key, int(time.time()), lbf_settings.PERMS_CACHE_TIMEOUT)
+        generation = cache.get(key, 0)
+    return generation
+
+
+def bump_generation(kind):
+    try:
+        cache.incr(_generation_key(kind))
+    except ValueError:
+        get_generation(kind)
+
+
+def _groups_key(kind, pk, generation):
+    return '{0}-{1}-groups-{2}'.format(pk, kind, generation)
+
+
+def get_objs_groups(obj):
+    '''
+    Names of the groups of a Forum or a User as a frozenset; no query once
+    cached.
+    '''
+    kind = obj._meta.object_name.lower()
+    ck = _groups_key(kind, obj.pk, get_generation(kind))
+    groups = cache.get(ck)
+    instrument.cache_lookup('groups', groups is not None)
+    if groups is None:
+        groups = frozenset(obj.groups.values_list('name', flat=True))
+        cache.set(ck, groups, lbf_settings.PERMS_CACHE_TIMEOUT)
+    return groups
+
+
+def invalidate_objs_groups(kind, pks):
+    generation = get_generation(kind)
+    cache.delete_many([_groups_key(kind, pk, generation) for pk in pks])
@@ -0,0 +1,111 @@
+# -*- coding: UTF-8 -*-
+"""
+Set-based recomputation of the topic and forum counters.
+
+Topic.update_state_info and Forum.update_state_info recompute one object
+with several queries. The functions below recompute every row of an id
+range with two UPDATE statements whose values are correlated aggregate
+subqueries, so the database does the counting next to the data and a
+range costs the same two round trips whatever its size. Ranges are
+independent, the rebuild_forum_stats command runs them in a process pool;
+all topic ranges have to be done before the forums, which sum the topics'
+num_replies.
+
+The results match update_state_info: num_topics and num_posts of a forum
+only count visible topics, the last post of a topic or forum is the one
+with the highest id.
+"""
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+
+from lbforum.models import Forum, Topic, Post
+
+_TABLES = {
+    'forum': Forum._meta.db_table,
+    'topic': Topic._meta.db_table,
+    'post': Post._meta.db_table,
+    'user': User._meta.db_table,
+}
+
+_LAST_POST_SQL = '''
+UPDATE {target} SET
+    {poster_id} = (SELECT p.posted_by_id FROM {post} p
+                   WHERE p.id = {target}.last_post_id),
+    {date} = COALESCE((SELECT p.created_on FROM {post} p
+                       WHERE p.id = {target}.last_post_id), {default_date}),
+    last_poster_name = COALESCE((SELECT u.username FROM {post} p, {user} u
+                                 WHERE p.id = {target}.last_post_id
+                                 AND u.id = p.posted_by_id), '')
+WHERE id >= %s AND id <= %s
+'''
+
+_TOPIC_SQL = '''
+UPDATE {topic} SET
+    num_replies = (SELECT COUNT(*) FROM {post} p
+                   WHERE p.topic_id = {topic}.id),
+    last_post_id = (SELECT MAX(p.id) FROM {post} p
+                    WHERE p.topic_id = {topic}.id)
+WHERE id >= %s AND id <= %s
+'''
+
+_FORUM_SQL = '''
+UPDATE {forum} SET
+    num_topics = (SELECT COUNT(*) FROM {topic} t
+                  WHERE t.forum_id = {forum}.id AND t.hidden = %s),
+    num_posts = COALESCE((SELECT SUM(t.num_replies) FROM {topic} t
+                          WHERE t.forum_id = {forum}.id AND t.hidden = %s), 0),
+    last_post_id = (SELECT MAX(p.id) FROM {post} p, {topic} t
+                    WHERE p.topic_id = t.id AND t.forum_id = {forum}.id)
+WHERE id >= %s AND id <= %s
+'''
+
+
+def _sql(template, **kwargs):
+    names = dict((k, connection.ops.quote_name(v)) for k, v in _TABLES.items())
+    for k, v in kwargs.items():
+        # a table key or a column name
+        names[k] = names.get(v, v)
+    return template.format(**names)
+
+
+def id_ranges(model, size):
+    '''
+    ``(first_id, last_id)`` ranges of at most size ids covering the table.
+    '''
+    cursor = connection.cursor()
+    cursor.execute('SELECT MIN(id), MAX(id) FROM %s'
+                   % connection.ops.quote_name(model._meta.db_table))
+    min_id, max_id = cursor.fetchone()
+    if min_id is None:
+        return []
+    return [(e, min(e + size - 1, max_id))
+            for e in range(min_id, max_id + 1, size)]
+
+
+@transaction.commit_on_success
+def rebuild_topics(first_id, last_id):
+    '''
+    Recompute num_replies and the last post of the topics of an id range.
+    '''
+    cursor = connection.cursor()
+    cursor.execute(_sql(_TOPIC_SQL), [first_id, last_id])
+    cursor.execute(_sql(_LAST_POST_SQL, target='topic',
+                        poster_id='last_poster_id', date='last_reply_on',
+                        default_date='last_reply_on'),
+                   [first_id, last_id])
+    return cursor.rowcount
+
+
+@transaction.commit_on_success
+def rebuild_forums(first_id, last_id):
+    '''
+    Recompute num_topics, num_posts and the last post of the forums of an
+    id range, from the (already rebuilt) topics.
+    '''
+    cursor = connection.cursor()
+    cursor.execute(_sql(_FORUM_SQL), [False, False, first_id, last_id])
+    cursor.execute(_sql(_LAST_POST_SQL, target='forum',
+                        poster_id='last_poster_id', date='last_post_on',
+                        default_date='NULL'),
+                   [first_id, last_id])
+    return cursor.rowcount
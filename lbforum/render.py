@@ -0,0 +1,141 @@
+# -*- coding: UTF-8 -*-
+import hashlib
+import re
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import get_language
+
+from attachments.models import Attachment
+
+from lbforum.templatetags.bbcode import _postmarkup, NEED_REPLY_MARKER
+from lbforum.templatetags.bbcode import need_reply_html, attach_html
+from lbforum.templatetags.bbcode import attachimg_html
+import settings as lbf_settings
+import instrument
+
+_render_cache_stats = {'hits': 0, 'misses': 0}
+
+_RE_MARKER = re.compile(r'<!--lbf-(attach|attachimg):(\d+)-->')
+
+
+def _render_cache_key(post_id, message, has_replied, language):
+    digest = hashlib.md5(message.encode('utf-8')).hexdigest()
+    return '{0}-post-render-{1}-{2}-{3}'.format(post_id, digest,
+                                                int(has_replied), language)
+
+
+def render_post(post_id, message, has_replied=False, attachments=None):
+    '''
+    Render the BBCode message of a post, reading from the render cache.
+    Returns a ``(html, hide_attachs)`` tuple.
+    :param post_id: Primary key of the post the message belongs to
+    :param message: The BBCode source of the post
+    :param has_replied: Whether the viewer may see [hide]/[replyview] content
+    :param attachments: Optional ``{pk: Attachment}`` map from
+    get_attachments_map, used instead of one query per [attach] tag
+    '''
+    has_replied = bool(has_replied)
+    ck = _render_cache_key(post_id, message, has_replied, get_language())
+    rendered = cache.get(ck)
+    instrument.cache_lookup('render', rendered is not None)
+    if rendered is not None:
+        _render_cache_stats['hits'] += 1
+        return rendered
+    _render_cache_stats['misses'] += 1
+    tag_data = {'has_replied': has_replied, 'attachments': attachments}
+    html = _postmarkup(message,  # cosmetic_replace=False,
+            tag_data=tag_data,
+            auto_urls=getattr(settings, 'BBCODE_AUTO_URLS', True))
+    rendered = (html, tag_data.get('hide_attachs', []))
+    cache.set(ck, rendered, lbf_settings.RENDER_CACHE_TIMEOUT)
+    return rendered
+
+
+def _render(message, has_replied, defer=False):
+    tag_data = {'has_replied': has_replied, 'defer': defer}
+    html = _postmarkup(message,  # cosmetic_replace=False,
+            tag_data=tag_data,
+            auto_urls=getattr(settings, 'BBCODE_AUTO_URLS', True))
+    return html, tag_data.get('hide_attachs', [])
+
+
+def store_rendering(post):
+    '''
+    Render the message of a post into its rendered fields, for viewers who
+    replied and for those who didn't. The second variant is only stored
+    when the parser hid something, otherwise it's left empty and the first
+    one is shown to everybody. The post isn't saved.
+    '''
+    post.rendered, hide_attachs = _render(post.message, True, defer=True)
+    # the parser decides what is a [replyview]/[hide] tag, [hide=x] included
+    noreply, hide_attachs = _render(post.message, False, defer=True)
+    if noreply == post.rendered:
+        noreply, hide_attachs = u'', []
+    post.rendered_noreply = noreply
+    post.rendered_hide_attachs = u','.join(hide_attachs)
+    post.rendered_version = lbf_settings.RENDER_VERSION
+
+
+def _resolve_markers(html, attachments):
+    pks = set(int(pk) for tag, pk in _RE_MARKER.findall(html))
+    missing = pks.difference(attachments)
+    if missing:
+        # remembered in the map, None for the deleted ones, so the next
+        # post referencing them doesn't query again
+        found = Attachment.objects.in_bulk(missing)
+        for pk in missing:
+            attachments[pk] = found.get(pk)
+
+    def attachment_html(match):
+        tag, pk = match.group(1), int(match.group(2))
+        attach = attachments[pk]
+        if attach is None:
+            return u'[%s]%s[/%s]' % (tag, pk, tag)
+        if tag == 'attach':
+            return attach_html(attach)
+        return attachimg_html(attach)
+    html = _RE_MARKER.sub(attachment_html, html)
+    return html.replace(NEED_REPLY_MARKER, need_reply_html())
+
+
+def render_stored_post(post, has_replied=False, attachments=None):
+    '''
+    The stored rendering of a post with its attachments and translated
+    text filled in, as a ``(html, hide_attachs)`` tuple like render_post,
+    or None when the post has no rendering for the current
+    LBF_RENDER_VERSION.
+    :param attachments: Optional ``{pk: Attachment}`` map from
+    get_attachments_map; the attachments missing from it are loaded with
+    one query and added to it
+    '''
+    if post.rendered_version != lbf_settings.RENDER_VERSION:
+        return None
+    html, hide_attachs = post.rendered, []
+    if not has_replied and post.rendered_noreply:
+        html = post.rendered_noreply
+        hide_attachs = [e for e in post.rendered_hide_attachs.split(',') if e]
+    if attachments is None:
+        attachments = {}
+    return _resolve_markers(html, attachments), hide_attachs
+
+
+def invalidate_post_render(post):
+    '''
+    Drop every cached rendering of the post's current message.
+    '''
+    languages = set([code for code, name in settings.LANGUAGES])
+    languages.add(settings.LANGUAGE_CODE)
+    keys = [_render_cache_key(post.pk, post.message, has_replied, language)
+            for has_replied in (False, True) for language in languages]
+    cache.delete_many(keys)
+
+
+def get_render_cache_stats():
+    '''
+    Hit/miss counters of the render cache for the current process.
+    '''
+    stats = dict(_render_cache_stats)
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = float(stats['hits']) / total if total else 0.0
+    return stats
@@ -0,0 +1,155 @@
+# -*- coding: UTF-8 -*-
+"""
+Full-text search over posts.
+
+The index is an inverted index in the PostSearchTerm table: one row per
+distinct term of a post, with the term frequency as weight and the forum of
+the post, so a search is one grouped query on the (term, forum_id) index
+that never reads Post. Terms are lowercased words of the message with the
+BBCode markup, quotes and attachments stripped; CJK text has no spaces and
+is indexed as overlapping bigrams. The terms of a topic's subject are added
+to its first post with a higher weight. STOPWORDS, the words most posts
+hold, are neither indexed nor searched: their posting lists would be read
+in full by every query holding them.
+
+A post is indexed again by its post_save signal and its rows are deleted by
+post_delete; the lbforum_rebuild_search_index command builds the index of
+existing posts.
+"""
+import re
+from collections import defaultdict
+
+from django.db.models import Sum, Count
+
+import settings as lbf_settings
+from latest import TopicIdList
+
+MAX_TERM_LENGTH = 40
+SUBJECT_WEIGHT = 5
+
+STOPWORDS = frozenset('''
+a about after all also am an and any are as at be because been but by can
+could did do does for from had has have he her him his how i if in into is
+it its just me my no not of on or our she so than that the their them then
+there these they this to too up us was we were what when which who will
+with would you your
+'''.split())
+
+_RE_STRIP_BLOCKS = re.compile(
+    r'\[(quote|attach|attachimg|img|code)(=[^\]]*)?\].*?\[/\1\]',
+    re.IGNORECASE | re.DOTALL)
+_RE_BBCODE_TAG = re.compile(r'\[/?[a-z*]+(=[^\]]*)?\]', re.IGNORECASE)
+_RE_WORD = re.compile(r'\w+', re.UNICODE)
+_CJK = u'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af'
+_RE_CJK_RUN = re.compile(u'([%s]+)' % _CJK)
+
+
+def strip_bbcode(message):
+    message = _RE_STRIP_BLOCKS.sub(' ', message)
+    return _RE_BBCODE_TAG.sub(' ', message)
+
+
+def tokenize(text):
+    '''
+    The terms of a text, in order and with repetitions.
+    '''
+    terms = []
+    for word in _RE_WORD.findall(text.lower()):
+        for i, run in enumerate(_RE_CJK_RUN.split(word)):
+            if i % 2:
+                # a CJK run, split() puts the captured runs at odd indexes
+                if len(run) == 1:
+                    terms.append(run)
+                terms.extend(run[j:j + 2] for j in range(len(run) - 1))
+            elif run:
+                terms.append(run[:MAX_TERM_LENGTH])
+    return terms
+
+
+def post_terms(post):
+    '''
+    ``{term: weight}`` of a post.
+    '''
+    weights = defaultdict(int)
+    for term in tokenize(strip_bbcode(post.message)):
+        weights[term] += 1
+    if post.topic_post:
+        for term in tokenize(post.topic.subject):
+            weights[term] += SUBJECT_WEIGHT
+    for term in STOPWORDS.intersection(weights):
+        del weights[term]
+    return weights
+
+
+def _index_rows(post):
+    from lbforum.models import PostSearchTerm
+    forum_id = post.topic.forum_id
+    return [PostSearchTerm(term=term, post_id=post.pk, forum_id=forum_id,
+                           weight=min(weight, 10000))
+            for term, weight in post_terms(post).items()]
+
+
+def _indexed_state(post):
+    subject = post.topic_post and post.topic.subject or None
+    return (post.message, subject, post.topic.forum_id)
+
+
+def index_post(post):
+    '''
+    Replace the index rows of a post, unless it was just indexed with the
+    same message (Post.save runs more than once for a new post).
+    '''
+    from lbforum.models import PostSearchTerm
+    state = _indexed_state(post)
+    if getattr(post, '_search_indexed', None) == state:
+        return
+    PostSearchTerm.objects.filter(post_id=post.pk).delete()
+    PostSearchTerm.objects.bulk_create(_index_rows(post))
+    post._search_indexed = state
+
+
+def index_posts(posts):
+    '''
+    Index posts that have no index rows yet, with one INSERT.
+    '''
+    from lbforum.models import PostSearchTerm
+    rows = []
+    for post in posts:
+        rows.extend(_index_rows(post))
+    PostSearchTerm.objects.bulk_create(rows)
+    return len(rows)
+
+
+def unindex_posts(post_ids):
+    from lbforum.models import PostSearchTerm
+    PostSearchTerm.objects.filter(post_id__in=post_ids).delete()
+
+
+def search(query, forum_ids, limit=None):
+    '''
+    Ids of the posts of forum_ids holding every term of query, best match
+    first: the sum of the weights of the terms, then the newest post. The
+    stopwords of query are ignored.
+    '''
+    from lbforum.models import PostSearchTerm
+    terms = set(tokenize(query)) - STOPWORDS
+    if not terms or not forum_ids:
+        return []
+    rows = PostSearchTerm.objects.filter(term__in=terms,
+                                         forum_id__in=forum_ids)
+    rows = rows.values('post_id').annotate(score=Sum('weight'),
+                                           matched=Count('id'))
+    rows = rows.filter(matched=len(terms)).order_by('-score', '-post_id')
+    limit = limit or lbf_settings.SEARCH_MAX_RESULTS
+    return [e['post_id'] for e in rows[:limit]]
+
+
+class PostIdList(TopicIdList):
+    '''
+    Like TopicIdList, for the posts of visible topics.
+    '''
+
+    def get_queryset(self):
+        from lbforum.models import Post
+        posts = Post.objects.filter(topic__hidden=False)
+        return posts.select_related('topic', 'topic__forum', 'posted_by')
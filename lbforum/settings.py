@@ -2,3 +2,50 @@ from django.conf import settings
 
 STICKY_TOPIC_POST = getattr(settings, 'LBF_STICKY_TOPIC_POST', False)
 LAST_TOPIC_NO_INDEX = getattr(settings, 'LBF_LAST_TOPIC_NO_INDEX', False)
+#seconds a rendered post message stays in the render cache
+RENDER_CACHE_TIMEOUT = getattr(settings, 'LBF_RENDER_CACHE_TIMEOUT', 60 * 60 * 24)
+#paginate forum and topic pages with keyset (seek) pagination
+KEYSET_PAGINATION = getattr(settings, 'LBF_KEYSET_PAGINATION', False)
+#number of leading pages still reachable by ?page=N in keyset mode
+KEYSET_PAGE_NUMBERS = getattr(settings, 'LBF_KEYSET_PAGE_NUMBERS', 5)
+#seconds between automatic flushes of buffered topic views, 0 to only flush
+#with the lbforum_flush_topic_views command
+VIEW_COUNT_FLUSH_INTERVAL = getattr(settings, 'LBF_VIEW_COUNT_FLUSH_INTERVAL', 60 * 5)
+#lifetime of the buffered view counters in the cache
+VIEW_COUNT_TIMEOUT = getattr(settings, 'LBF_VIEW_COUNT_TIMEOUT', 60 * 60 * 24)
+#seconds a cached permission lookup (visible forums, groups) is kept
+PERMS_CACHE_TIMEOUT = getattr(settings, 'LBF_PERMS_CACHE_TIMEOUT', 60 * 60 * 24)
+#seconds a model instance stays in the object cache
+OBJ_CACHE_TIMEOUT = getattr(settings, 'LBF_OBJ_CACHE_TIMEOUT', 500)
+#bump to drop every object cached by an older release
+OBJ_CACHE_VERSION = getattr(settings, 'LBF_OBJ_CACHE_VERSION', 1)
+#seconds the site statistics and the category/forum tree stay cached
+SITE_STATS_TIMEOUT = getattr(settings, 'LBF_SITE_STATS_TIMEOUT', 60 * 60 * 24)
+#number of topics kept in the cached latest topics list of each forum
+LATEST_TOPICS_NUM = getattr(settings, 'LBF_LATEST_TOPICS_NUM', 10)
+#seconds a latest topics list is kept before it's built again
+LATEST_TOPICS_TIMEOUT = getattr(settings, 'LBF_LATEST_TOPICS_TIMEOUT', 60 * 60 * 24)
+#number of topics kept in the cached recent activity feed
+RECENT_TOPICS_NUM = getattr(settings, 'LBF_RECENT_TOPICS_NUM', 500)
+#maximum number of posts a search returns
+SEARCH_MAX_RESULTS = getattr(settings, 'LBF_SEARCH_MAX_RESULTS', 500)
+#seconds between automatic flushes of buffered user activity, which bounds
+#how stale LBForumUserProfile.last_activity gets; 0 to only flush with the
+#lbforum_flush_user_activity command
+ACTIVITY_FLUSH_INTERVAL = getattr(settings, 'LBF_ACTIVITY_FLUSH_INTERVAL', 60)
+#lifetime of the buffered user activity in the cache
+ACTIVITY_TIMEOUT = getattr(settings, 'LBF_ACTIVITY_TIMEOUT', 60 * 60 * 24)
+#bump when the BBCode tags or the allowed HTML change, the posts rendered by
+#an older version are rendered on read until rerender_posts has run
+RENDER_VERSION = getattr(settings, 'LBF_RENDER_VERSION', 1)
+#record the queries, render times and cache hits of each request, see
+#lbforum.instrument.InstrumentMiddleware
+INSTRUMENT = getattr(settings, 'LBF_INSTRUMENT', False)
+#send the recording of a request as a Server-Timing header
+INSTRUMENT_HEADER = getattr(settings, 'LBF_INSTRUMENT_HEADER', True)
+#log each recording as a JSON line on the lbforum.instrument logger
+INSTRUMENT_LOG = getattr(settings, 'LBF_INSTRUMENT_LOG', True)
+#count each recording in the per view histograms of the cache
+INSTRUMENT_HISTOGRAMS = getattr(settings, 'LBF_INSTRUMENT_HISTOGRAMS', True)
+#lifetime of the histograms in the cache
+INSTRUMENT_TIMEOUT = getattr(settings, 'LBF_INSTRUMENT_TIMEOUT', 60 * 60 * 24 * 7)
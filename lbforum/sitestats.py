@@ -0,0 +1,125 @@
+# -*- coding: UTF-8 -*-
+"""
+Cached data of the sidebar widgets.
+
+The site statistics are one cache key per figure, adjusted with
+incr/decr by the post, topic and user signals and counted again only when
+a key is missing. The category/forum tree is cached as a whole and dropped
+when a category changes or a forum is created, deleted, renamed or moved;
+the widgets only show the names of its forums, whose counters are as of
+when the tree was built.
+
+Counters adjusted while their key is being recounted can be off by a few;
+the lbforum_reconcile_site_stats command recounts everything and is meant
+to run periodically.
+"""
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+import settings as lbf_settings
+import instrument
+
+TOTAL_TOPICS = 'total_topics'
+TOTAL_POSTS = 'total_posts'
+TOTAL_USERS = 'total_users'
+LAST_REGISTERED_USER = 'last_registered_user'
+SITE_STATS = (TOTAL_TOPICS, TOTAL_POSTS, TOTAL_USERS, LAST_REGISTERED_USER)
+
+CATEGORIES_TREE_KEY = 'categories-tree'
+
+
+def _stat_key(name):
+    return 'site-stats-{0}'.format(name)
+
+
+def _user_info(user):
+    return {'pk': user.pk, 'username': user.username}
+
+
+def _count_site_stat(name):
+    # models.py imports this module
+    from lbforum.models import Topic, Post
+    if name == TOTAL_TOPICS:
+        return Topic.objects.count()
+    if name == TOTAL_POSTS:
+        return Post.objects.count()
+    if name == TOTAL_USERS:
+        return User.objects.count()
+    users = User.objects.order_by('-date_joined')[:1]
+    return users and _user_info(users[0]) or None
+
+
+def get_site_stats():
+    '''
+    ``{name: value}`` for every name in SITE_STATS, read in one cache round
+    trip.
+    '''
+    cached = cache.get_many([_stat_key(e) for e in SITE_STATS])
+    instrument.cache_lookups('site_stats', len(cached),
+                             len(SITE_STATS) - len(cached))
+    stats = {}
+    for name in SITE_STATS:
+        value = cached.get(_stat_key(name))
+        if value is None:
+            value = _count_site_stat(name)
+            # add, not set: don't clobber a value adjusted meanwhile
+            cache.add(_stat_key(name), value, lbf_settings.SITE_STATS_TIMEOUT)
+        stats[name] = value
+    return stats
+
+
+def incr_site_stat(name, delta=1):
+    try:
+        if delta < 0:
+            cache.decr(_stat_key(name), -delta)
+        else:
+            cache.incr(_stat_key(name), delta)
+    except ValueError:
+        # not cached, the next read counts it
+        pass
+
+
+def invalidate_site_stat(name):
+    cache.delete(_stat_key(name))
+
+
+def set_last_registered_user(user):
+    cache.set(_stat_key(LAST_REGISTERED_USER), _user_info(user),
+              lbf_settings.SITE_STATS_TIMEOUT)
+
+
+def reconcile_site_stats():
+    '''
+    Count every site statistic again and drop the category/forum tree.
+    '''
+    stats = dict((name, _count_site_stat(name)) for name in SITE_STATS)
+    cache.set_many(dict((_stat_key(k), v) for k, v in stats.items()),
+                   lbf_settings.SITE_STATS_TIMEOUT)
+    invalidate_categories_tree()
+    return stats
+
+
+def get_categories_tree():
+    '''
+    The categories with their forums in ``category.forums``, built with two
+    queries when not cached.
+    '''
+    from lbforum.models import Category, Forum
+    categories = cache.get(CATEGORIES_TREE_KEY)
+    instrument.cache_lookup('categories_tree', categories is not None)
+    if categories is None:
+        categories = list(Category.objects.all())
+        forums = defaultdict(list)
+        for forum in Forum.objects.all():
+            forums[forum.category_id].append(forum)
+        for category in categories:
+            category.forums = forums[category.pk]
+        cache.set(CATEGORIES_TREE_KEY, categories,
+                  lbf_settings.SITE_STATS_TIMEOUT)
+    return categories
+
+
+def invalidate_categories_tree():
+    cache.delete(CATEGORIES_TREE_KEY)
@@ -9,6 +9,7 @@ from postmarkup import create, QuoteTag, TagBase, PostMarkup, strip_bbcode
 from attachments.models import Attachment
 
 from helper import clean_html
+from lbforum.instrument import timed
 
 register = template.Library()
 
@@ -16,6 +17,67 @@ register = template.Library()
 _RE_ATTACH = r"""\[attach\](\d*?)\[/attach\]"""
 _RE_ATTACHIMG = r"""\[attachimg\](\d*?)\[/attachimg\]"""
 
+# what the tags below render instead when tag_data['defer'] is set, for a
+# rendering stored with the post (see lbforum.render): attachments and the
+# translated notice are filled in when the post is displayed
+NEED_REPLY_MARKER = u'<!--lbf-need-reply-->'
+_ATTACH_MARKER = u'<!--lbf-%s:%s-->'
+
+
+def get_attachments_map(messages, attachments=None):
+    """
+    Resolve every [attach]/[attachimg] id found in messages with one query.
+    The result is meant to be passed to _postmarkup as tag_data['attachments'],
+    where an id missing from the map is a deleted attachment. Given a map,
+    only the ids it doesn't have yet are loaded and added to it, with None
+    for the deleted ones.
+    """
+    ids = set()
+    for message in messages:
+        if not message:
+            continue
+        ids.update(re.findall(_RE_ATTACH, message))
+        ids.update(re.findall(_RE_ATTACHIMG, message))
+    ids = [int(e) for e in ids if e]
+    if attachments is None:
+        if not ids:
+            return {}
+        return Attachment.objects.in_bulk(ids)
+    ids = [e for e in ids if e not in attachments]
+    if ids:
+        found = Attachment.objects.in_bulk(ids)
+        for pk in ids:
+            attachments[pk] = found.get(pk)
+    return attachments
+
+
+def _get_attachment(parser, contents):
+    attachments = parser.tag_data.get('attachments')
+    if attachments is not None:
+        # an id missing from the map doesn't exist, no query for it
+        try:
+            return attachments.get(int(contents))
+        except ValueError:
+            return None
+    try:
+        return Attachment.objects.get(pk=contents)
+    except:
+        return None
+
+
+def need_reply_html():
+    return u'<p class="need-reply">%s</p>' % ugettext("to see the content, user must reply first.")
+
+
+def attach_html(attach):
+    return u'<a title="%s" href="%s">%s</a>' % (attach.description,
+            attach.file.url, attach.org_filename)
+
+
+def attachimg_html(attach):
+    return u'<img title="%s" src="%s"/>' % (attach.description,
+            attach.file.url)
+
 
 class ReplyViewTag(TagBase):
 
@@ -28,7 +90,9 @@ class ReplyViewTag(TagBase):
             hide_attach.extend(re.findall(_RE_ATTACH, contents))
             hide_attach.extend(re.findall(_RE_ATTACHIMG, contents))
             tag_data['hide_attachs'] = hide_attach
-            return '<p class="need-reply">%s</p>' % ugettext("to see the content, user must reply first.")
+            if tag_data.get('defer'):
+                return NEED_REPLY_MARKER
+            return need_reply_html()
         return ""
 
 
@@ -52,13 +116,12 @@ class AttachTag(TagBase):
     def render_open(self, parser, node_index):
         contents = self.get_contents(parser)
         self.skip_contents(parser)
-        try:
-            attach = Attachment.objects.get(pk=contents)
-        except:
+        if parser.tag_data.get('defer') and contents.isdigit():
+            return _ATTACH_MARKER % ('attach', contents)
+        attach = _get_attachment(parser, contents)
+        if not attach:
             return u'[attach]%s[/attach]' % contents
-            pass
-        return u'<a title="%s" href="%s">%s</a>' % (attach.description,
-                attach.file.url, attach.org_filename)
+        return attach_html(attach)
 
 
 class AttachImgTag(TagBase):
@@ -69,13 +132,12 @@ class AttachImgTag(TagBase):
     def render_open(self, parser, node_index):
         contents = self.get_contents(parser)
         self.skip_contents(parser)
-        try:
-            attach = Attachment.objects.get(pk=contents)
-        except:
+        if parser.tag_data.get('defer') and contents.isdigit():
+            return _ATTACH_MARKER % ('attachimg', contents)
+        attach = _get_attachment(parser, contents)
+        if not attach:
             return u'[attachimg]%s[/attachimg]' % contents
-            pass
-        return u'<img title="%s" src="%s"/>' % (attach.description,
-                attach.file.url)
+        return attachimg_html(attach)
 
 
 class HTMLTag(TagBase):
@@ -87,7 +149,15 @@ class HTMLTag(TagBase):
         return clean_html(contents)
 
 
-_postmarkup = create(use_pygments=False, annotate_links=False)
+class _TimedPostMarkup(PostMarkup):
+
+    @timed('postmarkup')
+    def __call__(self, *args, **kwargs):
+        return PostMarkup.__call__(self, *args, **kwargs)
+
+
+_postmarkup = _TimedPostMarkup(
+    create(use_pygments=False, annotate_links=False).tag_factory)
 _postmarkup.tag_factory.add_tag(LBQuoteTag, 'quote')
 _postmarkup.tag_factory.add_tag(ReplyViewTag, 'replyview')
 _postmarkup.tag_factory.add_tag(ReplyViewTag, 'hide')
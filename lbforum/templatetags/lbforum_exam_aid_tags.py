@@ -1,20 +1,16 @@
 from django import template
 
-from lbforum.models import Forum
+from lbforum.latest import get_forum_by_slug, get_latest_topics
 
 register = template.Library()
 
 @register.inclusion_tag('lbforum/tags/exam_aid.html')
 def exam_aid_forum(exam_slug):
-    try:
-        forum = Forum.objects.get(slug=exam_slug)
-    except Forum.DoesNotExist:
-        forum = None
+    forum = get_forum_by_slug(exam_slug)
     if not forum:
         return {}
     
-    topics = forum.topic_set.all().order_by(
-                        '-last_reply_on').select_related()[:10]
+    topics = get_latest_topics(forum.pk)
     
     return {
         'forum':forum,
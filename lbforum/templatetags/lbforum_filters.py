@@ -11,6 +11,7 @@ from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 
 from bbcode import _postmarkup
+from lbforum.counters import get_topic_views
 
 register = template.Library()
 
@@ -49,6 +50,11 @@ def topic_state(topic):
     return ' '.join(c)
 
 
+@register.filter
+def num_views(topic):
+    return get_topic_views(topic)
+
+
 @register.filter
 def post_style(forloop):
     styles = ''
@@ -4,7 +4,8 @@ from django.conf import settings
 from django.utils.translation import ugettext as _
 from django.core.urlresolvers import reverse
 
-from bbcode import _postmarkup
+from bbcode import _postmarkup, get_attachments_map
+from lbforum.render import render_post, render_stored_post
 
 from djangohelper.decorators import basictag
 
@@ -13,10 +14,15 @@ register = template.Library()
 
 @register.tag
 @basictag(takes_context=True)
-def bbcode(context, s, has_replied=False):
+def bbcode(context, s, has_replied=False, post_id=None):
     if not s:
         return ""
-    tag_data = {'has_replied': has_replied}
+    attachments = context.get('bbcode_attachments')
+    if post_id is not None:
+        html, hide_attachs = render_post(post_id, s, has_replied, attachments)
+        context['hide_attachs'] = list(hide_attachs)
+        return html
+    tag_data = {'has_replied': has_replied, 'attachments': attachments}
     html = _postmarkup(s,  # cosmetic_replace=False,
             tag_data=tag_data,
             auto_urls=getattr(settings, 'BBCODE_AUTO_URLS', True))
@@ -24,6 +30,42 @@ def bbcode(context, s, has_replied=False):
     return html
 
 
+@register.tag
+@basictag(takes_context=True)
+def post_message(context, post, has_replied=False):
+    """
+    Like {% bbcode post.message has_replied post.pk %}, from the rendering
+    stored with the post when it's current.
+    """
+    attachments = context.get('bbcode_attachments')
+    if attachments is None:
+        # the attachments loaded for this post are reused by the next ones
+        attachments = context['bbcode_attachments'] = {}
+    rendered = render_stored_post(post, has_replied, attachments)
+    if rendered is None:
+        if not post.message:
+            return ""
+        # the map may only hold the attachments of the posts before
+        get_attachments_map([post.message], attachments)
+        rendered = render_post(post.pk, post.message, has_replied,
+                               attachments)
+    html, hide_attachs = rendered
+    context['hide_attachs'] = list(hide_attachs)
+    return html
+
+
+@register.simple_tag(takes_context=True)
+def prefetch_bbcode_attachments(context, posts):
+    """
+    Load the attachments referenced by the messages of posts in one query,
+    so that the {% bbcode %} calls that follow don't query per tag.
+    """
+    # with None for the deleted attachments, so nothing queries them again
+    context['bbcode_attachments'] = get_attachments_map(
+            [post.message for post in posts], {})
+    return ''
+
+
 @register.simple_tag
 def forum_url(forum):
     return reverse('lbforum_forum', args=[forum.slug])
@@ -1,7 +1,6 @@
 from django.template import Library
-from django.contrib.auth.models import User
 
-from lbforum.models import Topic, Category, Post
+from lbforum.sitestats import get_site_stats, get_categories_tree
 
 register = Library()
 
@@ -10,13 +9,11 @@ register = Library()
 def lbf_categories_and_forums(forum=None, template='lbforum/widgets/categories_and_forums.html'):
     return {'template': template,
             'forum': forum,
-            'categories': Category.objects.all()}
+            'categories': get_categories_tree()}
 
 
 @register.inclusion_tag('lbforum/tags/dummy.html')
 def lbf_status(template='lbforum/widgets/lbf_status.html'):
-    return {'template': template,
-            'total_topics': Topic.objects.count(),
-            'total_posts': Post.objects.count(),
-            'total_users': User.objects.count(),
-            'last_registered_user': User.objects.order_by('-date_joined')[0]}
+    context = get_site_stats()
+    context['template'] = template
+    return context
@@ -1,12 +1,67 @@
 # -*- coding: UTF-8 -*-
-from django.test import TestCase
+import datetime
+import os
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+
+from postmarkup import PostMarkup
+
+from django.test import TestCase, TransactionTestCase
+from django.conf import settings
+from django.http import Http404
+from django.test.client import RequestFactory
 from django.core.urlresolvers import reverse
+from django.core.cache import cache
+from django.contrib.auth.models import User, Group, AnonymousUser
+from django.core.management import call_command
+from django.db import connection, connections, DEFAULT_DB_ALIAS
+from django.db import DatabaseError
+from django.core.exceptions import MiddlewareNotUsed
+
+from lbforum.models import Forum, Topic, Post, LBForumUserProfile
+from lbforum.counters import incr_topic_views, flush_topic_views
+from lbforum.counters import get_topic_views, LiveViewsList
+from lbforum.counters import touch_user_activity, flush_user_activity
+from lbforum.counters import get_user_activity
+from lbforum.keyset import KeysetPaginator, encode_token
+from lbforum.views import get_visible_forum_ids
+from lbforum import views
+from lbforum.render import render_post, invalidate_post_render
+from lbforum.render import get_render_cache_stats
+from lbforum.render import store_rendering, render_stored_post
+from lbforum.templatetags.bbcode import get_attachments_map, _postmarkup
+from lbforum.templatetags.helper import clean_html
+from lbforum import objcache
+from lbforum.perms import get_objs_groups
+from lbforum import sitestats
+from lbforum import latest
+from lbforum import search
+from lbforum import settings as lbf_settings
+from lbforum.benchmark import CASES, generate, measure, check_budgets
+from lbforum.instrument import instrument, InstrumentMiddleware
+from lbforum.instrument import get_histograms
 
 
 class ViewsBaseCase(TestCase):
     fixtures = ['test_lbforum.json']
 
 
+class QueryCounter(object):
+    """Count the queries run inside a with block, like assertNumQueries."""
+
+    def __enter__(self):
+        self.old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.count = len(connection.queries) - self.start
+        connection.use_debug_cursor = self.old_debug_cursor
+
+
 class ViewsSimpleTest(ViewsBaseCase):
 
     def test_index(self):
@@ -31,3 +86,880 @@ class ViewsSimpleTest(ViewsBaseCase):
     def test_lang_js(self):
         resp = self.client.get(reverse('lbforum_lang_js'))
         self.assertEqual(resp.status_code, 200)
+
+
+class RenderCacheTest(ViewsBaseCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_render_post_cached(self):
+        post = Post.objects.get(pk=1)
+        before = get_render_cache_stats()
+        html, hide_attachs = render_post(post.pk, post.message)
+        self.assertEqual(render_post(post.pk, post.message), (html, hide_attachs))
+        after = get_render_cache_stats()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+
+    def test_invalidate_post_render(self):
+        post = Post.objects.get(pk=1)
+        render_post(post.pk, post.message)
+        invalidate_post_render(post)
+        before = get_render_cache_stats()
+        render_post(post.pk, post.message)
+        after = get_render_cache_stats()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+
+
+class StoredRenderingTest(ViewsBaseCase):
+
+    def test_variants(self):
+        post = Post.objects.get(pk=4)
+        post.message = u'[b]open[/b][hide]secret [attach]99[/attach][/hide]'
+        store_rendering(post)
+        replied, hide_attachs = render_stored_post(post, has_replied=True)
+        self.assertTrue('secret' in replied and '[attach]99[/attach]' in replied)
+        self.assertEqual(hide_attachs, [])
+        html, hide_attachs = render_stored_post(post)
+        self.assertFalse('secret' in html)
+        self.assertTrue('need-reply' in html and '<strong>open' in html)
+        self.assertEqual(hide_attachs, ['99'])
+
+    def test_tag_params(self):
+        post = Post.objects.get(pk=4)
+        for message in (u'[hide=x]secret[/hide]', u'[replyview 1]secret[/replyview]'):
+            post.message = message
+            store_rendering(post)
+            self.assertFalse('secret' in render_stored_post(post)[0])
+            self.assertTrue('secret' in render_stored_post(post, True)[0])
+        post.message = u'[b]open[/b]'
+        store_rendering(post)
+        self.assertEqual(post.rendered_noreply, u'')
+
+    def test_rerender_posts(self):
+        post = Post.objects.get(pk=1)
+        self.assertEqual(render_stored_post(post), None)
+        call_command('rerender_posts', processes=1, range_size=2,
+                     stdout=StringIO())
+        post = Post.objects.get(pk=1)
+        with self.assertNumQueries(0):
+            html, hide_attachs = render_stored_post(post)
+        self.assertEqual(html, render_post(post.pk, post.message)[0])
+
+    def test_missing_attachments_memoized(self):
+        post = Post.objects.get(pk=4)
+        post.message = u'[attach]98[/attach][attach]99[/attach]'
+        store_rendering(post)
+        attachments = {}
+        with self.assertNumQueries(1):
+            render_stored_post(post, attachments=attachments)
+            render_stored_post(post, attachments=attachments)
+        self.assertEqual(attachments, {98: None, 99: None})
+
+    def test_many_hidden_attachments(self):
+        post = Post.objects.get(pk=4)
+        post.message = u'[hide]%s[/hide]' % u''.join(
+            u'[attach]%s[/attach]' % (100000 + i) for i in range(100))
+        store_rendering(post)
+        post.save()
+        post = Post.objects.get(pk=4)
+        self.assertEqual(len(render_stored_post(post)[1]), 100)
+
+
+class CleanHtmlTest(TestCase):
+
+    def test_elements(self):
+        self.assertEqual(clean_html(u'<b>a</b><script>alert(1)</script><i>b</i>'),
+                         u'<b>a</b><i>b</i>')
+        # the sibling of a removed element is checked too
+        self.assertEqual(clean_html(u'<x></x><script>alert(1)</script>ok'),
+                         u'ok')
+        self.assertEqual(clean_html(u'<div><form><b>in</b></form>out'),
+                         u'<div>out</div>')
+
+    def test_attributes(self):
+        self.assertEqual(
+            clean_html(u'<p onclick="x()" title="a&quot;b">1 &amp; 2</p>'),
+            u'<p title="a&quot;b">1 &amp; 2</p>')
+        self.assertEqual(clean_html(u'x<br><img src="a.png" onerror="x()">'),
+                         u'x<br /><img src="a.png" />')
+
+    def test_nesting(self):
+        self.assertEqual(clean_html(u'<table><tr><td>1<td>2</table></i>'),
+                         u'<table><tr><td>1</td><td>2</td></tr></table>')
+        self.assertEqual(clean_html(u'<!-- c --><p>a<p>b'),
+                         u'<p>a</p><p>b</p>')
+
+    def test_references(self):
+        # an unterminated reference at the end isn't escaped twice, an
+        # unknown one without ; is text
+        self.assertEqual(clean_html(u'&foo bar &amp'), u'&amp;foo bar &amp;')
+        self.assertEqual(clean_html(u'&#39 &lt;b&gt; &foo; & x'),
+                         u'&#39; &lt;b&gt; &foo; &amp; x')
+
+
+class AttachmentsMapTest(ViewsBaseCase):
+
+    def test_no_attachments(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(get_attachments_map([u'no attachments', u'']), {})
+
+    def test_single_query(self):
+        messages = [u'[attach]1[/attach]', u'[attachimg]2[/attachimg][attach]1[/attach]']
+        with self.assertNumQueries(1):
+            get_attachments_map(messages)
+
+    def test_deleted_attachments(self):
+        messages = [u'[attach]98[/attach]', u'[attachimg]99[/attachimg]']
+        attachments = {}
+        with self.assertNumQueries(1):
+            get_attachments_map(messages, attachments)
+            get_attachments_map(messages, attachments)
+        self.assertEqual(attachments, {98: None, 99: None})
+        with self.assertNumQueries(0):
+            html = _postmarkup(u''.join(messages),
+                               tag_data={'attachments': {}})
+        self.assertTrue(u'[attach]98[/attach]' in html)
+
+
+class UserNumPostsTest(ViewsBaseCase):
+
+    def test_rebuild_num_posts(self):
+        LBForumUserProfile.objects.update(num_posts=0)
+        call_command('lbforum_update_user_num_posts')
+        for profile in LBForumUserProfile.objects.all():
+            self.assertEqual(profile.num_posts,
+                             Post.objects.filter(posted_by=profile.user).count())
+
+    def test_delete_post_decrements(self):
+        call_command('lbforum_update_user_num_posts')
+        post = Post.objects.get(pk=4)
+        post.delete()
+        profile = LBForumUserProfile.objects.get(user=post.posted_by_id)
+        self.assertEqual(profile.num_posts, 1)
+
+
+class TopicQueriesTest(ViewsBaseCase):
+
+    def get_topic_queries(self):
+        cache.clear()
+        with QueryCounter() as counter:
+            resp = self.client.get(reverse('lbforum_topic', args=(1, )))
+        self.assertEqual(resp.status_code, 200)
+        return counter.count
+
+    def test_topic_queries_constant(self):
+        num_queries = self.get_topic_queries()
+        first = Post.objects.get(pk=1)
+        for i in range(18):
+            post = Post(topic=first.topic, posted_by=first.posted_by,
+                        poster_ip='127.0.0.1', message=u'reply %s' % i)
+            post.save()
+        self.assertEqual(self.get_topic_queries(), num_queries)
+        self.assertLess(num_queries, 10)
+
+
+class KeysetPaginatorTest(ViewsBaseCase):
+
+    def test_walk_forward_and_back(self):
+        first = Post.objects.get(pk=1)
+        for i in range(23):
+            Post(topic=first.topic, posted_by=first.posted_by,
+                 poster_ip='127.0.0.1', message=u'reply %s' % i).save()
+        qs = first.topic.posts.all()
+        expected = list(qs.order_by('created_on', 'id'))
+        paginator = KeysetPaginator(qs, ('created_on', 'id'), 10,
+                                    count=len(expected))
+        factory = RequestFactory()
+        pages = [paginator.page(factory.get('/'))]
+        while pages[-1].has_next():
+            pages.append(paginator.page(factory.get(pages[-1].next_query())))
+        self.assertEqual(sum([e.object_list for e in pages], []), expected)
+        self.assertEqual([e.start_index() for e in pages], [1, 11, 21])
+        back = paginator.page(factory.get(pages[-1].previous_query()))
+        self.assertEqual(back.object_list, pages[-2].object_list)
+
+    def test_deep_pages(self):
+        page_numbers = lbf_settings.KEYSET_PAGE_NUMBERS
+        keyset_pagination = lbf_settings.KEYSET_PAGINATION
+        lbf_settings.KEYSET_PAGE_NUMBERS = 1
+        lbf_settings.KEYSET_PAGINATION = True
+        try:
+            first = Post.objects.get(pk=1)
+            qs = first.topic.posts.all()
+            paginator = KeysetPaginator(qs, ('created_on', 'id'), 1)
+            factory = RequestFactory()
+            self.assertRaises(Http404, paginator.page,
+                              factory.get('/', {'page': 2}))
+            token = encode_token([u'not a date', 1], 0)
+            self.assertRaises(Http404, paginator.page,
+                              factory.get('/', {'after': token}))
+            post = Post(topic=first.topic, posted_by=first.posted_by,
+                        poster_ip='127.0.0.1', message=u'reply')
+            post.save()
+            post.position = settings.CTX_CONFIG['TOPIC_PAGE_SIZE'] + 1
+            url = post.get_absolute_url_ext()
+            self.assertTrue('?after=' in url)
+            resp = self.client.get(url)
+            self.assertEqual(resp.context['posts'][0], post)
+        finally:
+            lbf_settings.KEYSET_PAGE_NUMBERS = page_numbers
+            lbf_settings.KEYSET_PAGINATION = keyset_pagination
+
+
+class PostPositionTest(ViewsBaseCase):
+
+    def test_positions(self):
+        call_command('lbforum_update_post_positions')
+        first = Post.objects.get(pk=1)
+        self.assertEqual(first.position, 1)
+        self.assertEqual(Post.objects.get(pk=4).position, 2)
+        post = Post(topic=first.topic, posted_by=first.posted_by,
+                    poster_ip='127.0.0.1', message=u'reply')
+        post.save()
+        self.assertEqual(post.position, 3)
+        Post.objects.get(pk=4).delete()
+        self.assertEqual(Post.objects.get(pk=post.pk).position, 2)
+        self.assertTrue(post.get_absolute_url_ext().endswith(
+            '?page=1#p%s' % post.pk))
+        post = Post(topic=first.topic, posted_by=first.posted_by,
+                    poster_ip='127.0.0.1', message=u'reply')
+        post.save()
+        self.assertEqual(post.position, 3)
+        self.assertEqual(Topic.objects.get(pk=first.topic_id).num_replies, 3)
+
+
+class TopicViewsTest(ViewsBaseCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_buffered_views(self):
+        num_views = Topic.objects.get(pk=1).num_views
+        for i in range(3):
+            incr_topic_views(1)
+        self.assertEqual(get_topic_views(Topic.objects.get(pk=1)), num_views + 3)
+        flush_topic_views()
+        topic = Topic.objects.get(pk=1)
+        self.assertEqual(topic.num_views, num_views + 3)
+        self.assertEqual(get_topic_views(topic), num_views + 3)
+        incr_topic_views(1)
+        flush_topic_views()
+        self.assertEqual(Topic.objects.get(pk=1).num_views, num_views + 4)
+
+    def test_live_views_page(self):
+        topics = Topic.objects.order_by('pk')
+        expected = [e.num_views for e in topics]
+        incr_topic_views(2)
+        incr_topic_views(2)
+        expected[1] += 2
+        topics = LiveViewsList(topics)
+        self.assertEqual(len(topics), len(expected))
+        page = topics[0:2]
+        self.assertEqual([e.live_num_views for e in page], expected)
+        resp = self.client.get(reverse('lbforum_forum', args=("forum", )))
+        self.assertContains(resp, '<strong>%s</strong>' % expected[1])
+
+
+class UserActivityTest(ViewsBaseCase):
+
+    def setUp(self):
+        cache.clear()
+        # flush by hand only
+        self.flush_interval = lbf_settings.ACTIVITY_FLUSH_INTERVAL
+        lbf_settings.ACTIVITY_FLUSH_INTERVAL = 0
+
+    def tearDown(self):
+        lbf_settings.ACTIVITY_FLUSH_INTERVAL = self.flush_interval
+
+    def test_buffered_activity(self):
+        profile = LBForumUserProfile.objects.get(user=2)
+        LBForumUserProfile.objects.filter(user=1).delete()
+        when = profile.last_activity + datetime.timedelta(days=1)
+        with QueryCounter() as counter:
+            touch_user_activity(2, when - datetime.timedelta(hours=1))
+            touch_user_activity(2, when)
+            touch_user_activity(1, when)
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(get_user_activity(profile), when)
+        self.assertEqual(flush_user_activity(), 2)
+        self.assertEqual(LBForumUserProfile.objects.get(user=2).last_activity,
+                         when)
+        self.assertTrue(LBForumUserProfile.objects.filter(user=1).exists())
+        later = when + datetime.timedelta(hours=1)
+        touch_user_activity(2, later)
+        self.assertEqual(flush_user_activity(), 1)
+        self.assertEqual(LBForumUserProfile.objects.get(user=2).last_activity,
+                         later)
+
+
+class ConcurrentCountersTest(TransactionTestCase):
+    fixtures = ['test_lbforum.json']
+    num_threads = 8
+    posts_per_thread = 25
+
+    def setUp(self):
+        self.memory = None
+        settings_dict = connection.settings_dict
+        if settings_dict['NAME'] != ':memory:':
+            return
+        # each thread would get an in-memory database of its own, the posts
+        # go to a file database shared by all of them instead
+        self.memory = connections[DEFAULT_DB_ALIAS]
+        self.test_name = settings_dict.get('TEST_NAME')
+        fd, path = tempfile.mkstemp(suffix='.sqlite3', prefix='lbforum-test')
+        os.close(fd)
+        settings_dict['TEST_NAME'] = path
+        connections[DEFAULT_DB_ALIAS] = self.memory.__class__(
+            settings_dict, DEFAULT_DB_ALIAS)
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        call_command('loaddata', *self.fixtures, verbosity=0)
+
+    def tearDown(self):
+        if self.memory is None:
+            return
+        settings_dict = connection.settings_dict
+        path = settings_dict['NAME']
+        connection.close()
+        os.remove(path)
+        settings_dict['NAME'] = ':memory:'
+        settings_dict['TEST_NAME'] = self.test_name
+        connections[DEFAULT_DB_ALIAS] = self.memory
+
+    def new_posts(self, topic, user):
+        try:
+            for i in range(self.posts_per_thread):
+                while True:
+                    try:
+                        Post(topic=topic, posted_by=user, poster_ip='127.0.0.1',
+                             message=u'reply %s' % i).save()
+                        break
+                    except DatabaseError as e:
+                        # sqlite has one writer, the others wait their turn
+                        if 'locked' not in str(e):
+                            raise
+                        time.sleep(0.01)
+        finally:
+            connection.close()
+
+    def test_parallel_posts(self):
+        topic = Topic.objects.select_related('forum', 'posted_by').get(pk=1)
+        forum = topic.forum
+        profile = LBForumUserProfile.objects.get(user=topic.posted_by)
+        threads = [threading.Thread(target=self.new_posts,
+                                    args=(topic, topic.posted_by))
+                   for i in range(self.num_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        num_new = self.num_threads * self.posts_per_thread
+        self.assertEqual(Topic.objects.get(pk=1).num_replies,
+                         topic.num_replies + num_new)
+        self.assertEqual(Forum.objects.get(pk=forum.pk).num_posts,
+                         forum.num_posts + num_new)
+        self.assertEqual(LBForumUserProfile.objects.get(pk=profile.pk).num_posts,
+                         profile.num_posts + num_new)
+        positions = Post.objects.filter(topic=1, position__gt=topic.num_replies)
+        self.assertEqual(sorted(positions.values_list('position', flat=True)),
+                         range(topic.num_replies + 1,
+                               topic.num_replies + num_new + 1))
+
+
+class InterleavedCountersTest(ViewsBaseCase):
+
+    def new_post(self, topic):
+        post = Post(topic=topic, posted_by_id=topic.posted_by_id,
+                    poster_ip='127.0.0.1', message=u'reply')
+        post.save()
+        return post
+
+    def test_interleaved_posts(self):
+        # both requests load the rows before either of them posts
+        topic_a = Topic.objects.select_related('forum').get(pk=1)
+        topic_b = Topic.objects.select_related('forum').get(pk=1)
+        forum = topic_a.forum
+        profile = LBForumUserProfile.objects.get(user=topic_a.posted_by_id)
+        post_a = self.new_post(topic_a)
+        self.assertEqual(Topic.objects.get(pk=1).num_replies,
+                         topic_a.num_replies + 1)
+        self.assertEqual(Forum.objects.get(pk=forum.pk).num_posts,
+                         forum.num_posts + 1)
+        post_b = self.new_post(topic_b)
+        self.assertEqual(Topic.objects.get(pk=1).num_replies,
+                         topic_a.num_replies + 2)
+        self.assertEqual(Forum.objects.get(pk=forum.pk).num_posts,
+                         forum.num_posts + 2)
+        self.assertEqual(LBForumUserProfile.objects.get(pk=profile.pk).num_posts,
+                         profile.num_posts + 2)
+        self.assertEqual((post_a.position, post_b.position),
+                         (topic_a.num_replies + 1, topic_a.num_replies + 2))
+
+
+class VisibleForumsTest(ViewsBaseCase):
+
+    def setUp(self):
+        cache.clear()
+        self.group = Group.objects.create(name='members')
+        self.forum = Forum.objects.create(name='private', slug='private',
+                                          category_id=1)
+        self.forum.groups.add(self.group)
+
+    def test_visible_forums(self):
+        user = User.objects.get(username='vicalloy')
+        admin = User.objects.get(username='admin')
+        self.assertEqual(get_visible_forum_ids(AnonymousUser()), [1])
+        self.assertEqual(get_visible_forum_ids(user), [1])
+        self.assertEqual(sorted(get_visible_forum_ids(admin)),
+                         [1, self.forum.pk])
+        user.groups.add(self.group)
+        self.assertEqual(sorted(get_visible_forum_ids(user)),
+                         [1, self.forum.pk])
+        self.forum.groups.clear()
+        self.assertEqual(sorted(get_visible_forum_ids(AnonymousUser())),
+                         [1, self.forum.pk])
+
+
+class ObjCacheTest(ViewsBaseCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_models_dont_share_keys(self):
+        self.assertEqual(objcache.get_cached_obj(Topic, 1).pk, 1)
+        post = objcache.get_cached_obj(Post, 1)
+        self.assertTrue(isinstance(post, Post))
+        self.assertTrue(isinstance(objcache.get_cached_obj(Forum, 1), Forum))
+
+    def test_invalidated_on_save(self):
+        topic = objcache.get_cached_obj(Topic, 1)
+        Topic.objects.filter(pk=1).update(subject='stale')
+        self.assertNotEqual(objcache.get_cached_obj(Topic, 1).subject, 'stale')
+        topic.subject = 'fresh'
+        topic.save()
+        self.assertEqual(objcache.get_cached_obj(Topic, '1').subject, 'fresh')
+
+    def test_get_many(self):
+        objcache.get_cached_obj(Post, 1)
+        with QueryCounter() as counter:
+            posts = objcache.get_many(Post, ['1', 2, 3, 999])
+        self.assertEqual(sorted(posts.keys()), [1, 2, 3])
+        self.assertEqual(counter.count, 1)
+        with QueryCounter() as counter:
+            objcache.get_many(Post, [1, 2, 3])
+        self.assertEqual(counter.count, 0)
+        self.assertTrue(objcache.get_stats()['lbforum.post']['hits'] >= 4)
+
+    def test_get_objs(self):
+        lookups = [(Topic, '1'), (Forum, 1), (Post, None), (Post, 'x'),
+                   (User, 999)]
+        with QueryCounter() as counter:
+            objs = objcache.get_objs(lookups)
+        # one in_bulk per model with misses
+        self.assertEqual(counter.count, 3)
+        self.assertEqual([e and e.pk for e in objs], [1, 1, None, None, None])
+        with QueryCounter() as counter:
+            objcache.get_objs(lookups[:2])
+        self.assertEqual(counter.count, 0)
+
+    def test_new_reply_quote(self):
+        user = User.objects.get(username='vicalloy')
+        user.set_password('vicalloy')
+        user.save()
+        self.client.login(username='vicalloy', password='vicalloy')
+        url = reverse('lbforum_new_replay', args=(2, ))
+        resp = self.client.get(url + '?qid=3')
+        self.assertContains(resp, '[quote=admin]reply[/quote]')
+        resp = self.client.get(url + '?qid=999')
+        self.assertEqual(resp.status_code, 404)
+
+
+class PermsCacheTest(ViewsBaseCase):
+
+    def setUp(self):
+        cache.clear()
+        self.group = Group.objects.create(name='members')
+        self.user = User.objects.get(username='vicalloy')
+        self.forum = Forum.objects.get(pk=1)
+
+    def test_cached_without_queries(self):
+        self.assertEqual(get_objs_groups(self.user), frozenset())
+        with QueryCounter() as counter:
+            self.assertEqual(get_objs_groups(self.user), frozenset())
+            self.assertEqual(get_objs_groups(self.forum), frozenset())
+            self.assertEqual(get_objs_groups(self.forum), frozenset())
+        self.assertEqual(counter.count, 1)
+
+    def test_m2m_changes_invalidate(self):
+        get_objs_groups(self.user)
+        get_objs_groups(self.forum)
+        self.user.groups.add(self.group)
+        self.forum.groups.add(self.group)
+        self.assertEqual(get_objs_groups(self.user), frozenset(['members']))
+        self.assertEqual(get_objs_groups(self.forum), frozenset(['members']))
+        self.group.user_set.clear()
+        self.assertEqual(get_objs_groups(self.user), frozenset())
+        self.group.name = 'staff'
+        self.group.save()
+        self.assertEqual(get_objs_groups(self.forum), frozenset(['staff']))
+
+
+class ForumPermissionTest(ViewsBaseCase):
+
+    def setUp(self):
+        cache.clear()
+        self.group = Group.objects.create(name='members')
+        Forum.objects.get(pk=1).groups.add(self.group)
+        self.user = User.objects.get(username='vicalloy')
+        self.user.set_password('vicalloy')
+        self.user.save()
+        self.url = reverse('lbforum_topic', args=(1, ))
+
+    def test_denied_before_render(self):
+        self.client.get(self.url)
+        with QueryCounter() as counter:
+            resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 302)
+        # the topic, no group or rendering queries
+        self.assertEqual(counter.count, 1)
+
+    def test_member_allowed(self):
+        self.client.login(username='vicalloy', password='vicalloy')
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 302)
+        self.user.groups.add(self.group)
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+
+
+class SiteStatsTest(ViewsBaseCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_kept_up_to_date(self):
+        stats = sitestats.get_site_stats()
+        self.assertEqual(stats['total_topics'], 2)
+        self.assertEqual(stats['total_posts'], 4)
+        self.assertEqual(stats['total_users'], 2)
+        topic = Topic.objects.get(pk=1)
+        Post.objects.create(topic=topic, posted_by=topic.posted_by,
+                            poster_ip='127.0.0.1', message='hi')
+        user = User.objects.create_user('newbie', 'newbie@example.com')
+        with QueryCounter() as counter:
+            stats = sitestats.get_site_stats()
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(stats['total_posts'], 5)
+        self.assertEqual(stats['total_users'], 3)
+        self.assertEqual(stats['last_registered_user']['pk'], user.pk)
+        Post.objects.get(pk=4).delete()
+        self.assertEqual(sitestats.get_site_stats()['total_posts'], 4)
+
+    def test_categories_tree(self):
+        categories = sitestats.get_categories_tree()
+        self.assertEqual([f.pk for f in categories[0].forums], [1])
+        with QueryCounter() as counter:
+            sitestats.get_categories_tree()
+        self.assertEqual(counter.count, 0)
+        topic = Topic.objects.get(pk=1)
+        Post.objects.create(topic=topic, posted_by=topic.posted_by,
+                            poster_ip='127.0.0.1', message='hi')
+        forum = Forum.objects.get(pk=1)
+        forum.update_state_info()
+        with QueryCounter() as counter:
+            sitestats.get_categories_tree()
+        self.assertEqual(counter.count, 0)
+        forum.name = u'renamed'
+        forum.save()
+        forum = sitestats.get_categories_tree()[0].forums[0]
+        self.assertEqual(forum.name, u'renamed')
+
+    def test_topic_saves(self):
+        self.assertEqual(sitestats.get_site_stats()['total_topics'], 2)
+        topic = Topic.objects.get(pk=1)
+        topic.subject = u'edited'
+        topic.save()
+        topic.hidden = True
+        topic.save()
+        with QueryCounter() as counter:
+            stats = sitestats.get_site_stats()
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(stats['total_topics'], 1)
+
+    def test_reconcile(self):
+        sitestats.get_site_stats()
+        sitestats.incr_site_stat('total_topics', 5)
+        call_command('lbforum_reconcile_site_stats')
+        self.assertEqual(sitestats.get_site_stats()['total_topics'], 2)
+
+
+class LatestTopicsTest(ViewsBaseCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_updated_in_place(self):
+        self.assertEqual([t.pk for t in latest.get_latest_topics(1)], [1, 2])
+        topic = Topic.objects.get(pk=2)
+        Post.objects.create(topic=topic, posted_by=topic.posted_by,
+                            poster_ip='127.0.0.1', message='hi')
+        with QueryCounter() as counter:
+            topics = latest.get_latest_topics(1)
+            self.assertEqual(latest.get_forum_by_slug('forum').pk, 1)
+            latest.get_forum_by_slug('forum')
+        self.assertEqual([t.pk for t in topics], [2, 1])
+        self.assertEqual(topics[0].num_replies, topic.num_replies + 1)
+        self.assertEqual(counter.count, 1)
+
+    def test_hidden_topic_dropped(self):
+        latest.get_latest_topics(1)
+        topic = Topic.objects.get(pk=1)
+        topic.hidden = True
+        topic.save()
+        self.assertEqual([t.pk for t in latest.get_latest_topics(1)], [2])
+
+    def test_renamed_slug(self):
+        self.assertEqual(latest.get_forum_by_slug('forum').pk, 1)
+        forum = Forum.objects.get(pk=1)
+        forum.slug = 'renamed'
+        forum.save()
+        self.assertEqual(latest.get_forum_by_slug('forum'), None)
+        self.assertEqual(latest.get_forum_by_slug('renamed').pk, 1)
+
+
+class RecentTopicsTest(ViewsBaseCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_feed(self):
+        self.assertEqual([e[1] for e in latest.get_recent_topics([1])], [1, 2])
+        topic = Topic.objects.get(pk=2)
+        Post.objects.create(topic=topic, posted_by=topic.posted_by,
+                            poster_ip='127.0.0.1', message='hi')
+        with QueryCounter() as counter:
+            entries = latest.get_recent_topics([1])
+        self.assertEqual(counter.count, 0)
+        self.assertEqual([e[1] for e in entries], [2, 1])
+
+    def test_capped_after_the_forums_filter(self):
+        recent_topics_num = lbf_settings.RECENT_TOPICS_NUM
+        lbf_settings.RECENT_TOPICS_NUM = 1
+        try:
+            forum = Forum.objects.create(name='other', slug='other',
+                                         category_id=1)
+            topic = Topic.objects.create(forum=forum, posted_by_id=1,
+                                         subject=u'newer')
+            Post.objects.create(topic=topic, posted_by_id=1,
+                                poster_ip='127.0.0.1', message='hi')
+            self.assertEqual([e[1] for e in latest.get_recent_topics(
+                [1, forum.pk])], [topic.pk])
+            self.assertEqual([e[1] for e in latest.get_recent_topics([1])],
+                             [1])
+        finally:
+            lbf_settings.RECENT_TOPICS_NUM = recent_topics_num
+
+    def test_paginated(self):
+        resp = self.client.get(reverse('lbforum_recent'))
+        self.assertEqual(resp.context['paginator'].count, 2)
+        self.assertEqual([t.pk for t in resp.context['topics']], [1, 2])
+        resp = self.client.get(reverse('lbforum_recent') + '?page=2')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_topic_id_list(self):
+        topics = latest.TopicIdList([2, 1])
+        self.assertEqual(len(topics), 2)
+        with QueryCounter() as counter:
+            self.assertEqual([t.pk for t in topics[1:]], [1])
+        self.assertEqual(counter.count, 1)
+
+    def test_filtered_by_visible_forums(self):
+        group = Group.objects.create(name='members')
+        Forum.objects.get(pk=1).groups.add(group)
+        resp = self.client.get(reverse('lbforum_recent'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.context['topics']), 0)
+
+
+class ExplainQueriesTest(ViewsBaseCase):
+
+    def test_reports_every_query(self):
+        out = StringIO()
+        call_command('lbforum_explain_queries', stdout=out)
+        self.assertTrue('forum topics: ' in out.getvalue())
+        self.assertTrue('user posts: ' in out.getvalue())
+
+
+class SearchTest(ViewsBaseCase):
+
+    def setUp(self):
+        cache.clear()
+        call_command('lbforum_rebuild_search_index', stdout=StringIO())
+
+    def test_tokenize(self):
+        self.assertEqual(search.tokenize(u'Hello, World hello'),
+                         [u'hello', u'world', u'hello'])
+        self.assertEqual(search.tokenize(u'\u4e2d\u6587\u5206'),
+                         [u'\u4e2d\u6587', u'\u6587\u5206'])
+        self.assertEqual(search.tokenize(search.strip_bbcode(
+            u'[b]bold[/b] [quote=a]quoted[/quote] [attach]1[/attach]')),
+            [u'bold'])
+
+    def test_ranked(self):
+        self.assertEqual(search.search(u'reply', [1]), [4, 3])
+        self.assertEqual(search.search(u'user reply', [1]), [4])
+        self.assertEqual(search.search(u'reply', []), [])
+        self.assertEqual(search.search(u'reply', [2]), [])
+        # stopwords are neither indexed nor searched
+        self.assertEqual(search.search(u'the user reply', [1]), [4])
+        self.assertEqual(search.search(u'the', [1]), [])
+
+    def test_moved_topic(self):
+        forum = Forum.objects.create(name='other', slug='other', category_id=1)
+        topic = Topic.objects.get(pk=1)
+        with QueryCounter() as counter:
+            topic.save()
+        not_moved = counter.count
+        topic.forum = forum
+        with QueryCounter() as counter:
+            topic.save()
+        # one more, the UPDATE of the index rows
+        self.assertEqual(counter.count, not_moved + 1)
+        self.assertEqual(search.search(u'user reply', [forum.pk]), [4])
+
+    def test_incremental(self):
+        topic = Topic.objects.get(pk=1)
+        post = Post.objects.create(topic=topic, posted_by=topic.posted_by,
+                                   poster_ip='127.0.0.1',
+                                   message='[b]searchable[/b] reply reply')
+        self.assertEqual(search.search(u'searchable', [1]), [post.pk])
+        self.assertEqual(search.search(u'reply', [1])[0], post.pk)
+        post.delete()
+        self.assertEqual(search.search(u'searchable', [1]), [])
+
+    def test_view(self):
+        resp = self.client.get(reverse('lbforum_search'), {'q': 'reply'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([p.pk for p in resp.context['posts']], [4, 3])
+
+
+class MaintenanceCommandsTest(ViewsBaseCase):
+
+    def test_update_posts(self):
+        Post.objects.filter(pk=1).update(has_imgs=True)
+        Topic.objects.filter(pk=1).update(has_imgs=True)
+        call_command('update_posts', chunk_size=2, stdout=StringIO())
+        self.assertFalse(Post.objects.filter(has_imgs=True).exists())
+        self.assertFalse(Topic.objects.filter(has_imgs=True).exists())
+
+    def test_set_topic_post(self):
+        Topic.objects.update(post=None)
+        call_command('lbforum_set_topic_post', chunk_size=1, stdout=StringIO())
+        for topic in Topic.objects.all():
+            first_post = topic.posts.order_by('created_on')[0]
+            self.assertEqual(topic.post_id, first_post.pk)
+
+    def test_init_user_profile(self):
+        LBForumUserProfile.objects.all().delete()
+        out = StringIO()
+        call_command('init_lbforum_user_profile', after_id=1, stdout=out)
+        self.assertEqual(list(LBForumUserProfile.objects.values_list(
+            'user', 'num_posts')), [(2, 2)])
+        self.assertTrue('last id 2' in out.getvalue())
+
+
+class RebuildForumStatsTest(ViewsBaseCase):
+
+    def test_rebuild_forum_stats(self):
+        Topic.objects.update(num_replies=0, last_post_id=None,
+                             last_poster_name='')
+        Forum.objects.update(num_topics=0, num_posts=0, last_post_id=None,
+                             last_poster_name='', last_post_on=None)
+        cache.clear()
+        objcache.get_cached_obj(Topic, 1)
+        call_command('rebuild_forum_stats', processes=1, range_size=1,
+                     stdout=StringIO())
+        self.assertEqual(objcache.get_cached_obj(Topic, 1).num_replies,
+                         Topic.objects.get(pk=1).num_replies)
+        for topic in Topic.objects.all():
+            expected = Topic.objects.get(pk=topic.pk)
+            expected.update_state_info(commit=False)
+            self.assertEqual(topic.num_replies, expected.num_replies)
+            self.assertEqual(topic.last_post_id, expected.last_post_id)
+            self.assertEqual(topic.last_poster_name, expected.last_poster_name)
+        forum = Forum.objects.get(pk=1)
+        expected = Forum.objects.get(pk=1)
+        expected.update_state_info(commit=False)
+        self.assertEqual((forum.num_topics, forum.num_posts),
+                         (expected.num_topics, expected.num_posts))
+        self.assertEqual(forum.last_post_id, expected.last_post_id)
+        self.assertEqual(forum.last_post_on, expected.last_post_on)
+
+
+class BenchmarkTest(TestCase):
+
+    def test_cases(self):
+        ctx = generate(forums=2, topics=5, posts=20, users=3, attachments=2,
+                       restricted=1)
+        self.assertEqual(Post.objects.count(), 20)
+        self.assertEqual(Topic.objects.get(pk=ctx['topic_id']).num_replies,
+                         Post.objects.filter(topic=ctx['topic_id']).count())
+        results = dict((name, measure(func, ctx, repeat=1))
+                       for name, func in CASES)
+        self.assertEqual(check_budgets(results, {}), [])
+
+    def test_check_budgets(self):
+        results = {'a': {'time': 1.1, 'queries': 3}, 'b': {'error': 'boom'}}
+        self.assertEqual(check_budgets(results, {'a': {'time': 1.0,
+                                                       'queries': 3}}),
+                         ['b: boom'])
+        self.assertEqual(len(check_budgets(results, {'a': {'queries': 2},
+                                                     'c': {}})), 3)
+
+
+class InstrumentTest(ViewsBaseCase):
+
+    def setUp(self):
+        cache.clear()
+        self.enabled = lbf_settings.INSTRUMENT
+
+    def tearDown(self):
+        lbf_settings.INSTRUMENT = self.enabled
+
+    def test_instrument(self):
+        with instrument() as recorder:
+            Topic.objects.count()
+            objcache.get_cached_obj(Topic, 1)
+            objcache.get_cached_obj(Topic, 1)
+            clean_html(u'<b>bold</b>')
+        self.assertEqual(recorder.num_queries, 2)
+        self.assertEqual(recorder.cache['objcache'], [1, 1])
+        self.assertEqual(recorder.calls['clean_html'], 1)
+        clean_html(u'<b>bold</b>')
+        self.assertEqual(recorder.calls['clean_html'], 1)
+
+    def test_timed_callables(self):
+        self.assertEqual(clean_html.__name__, 'clean_html')
+        self.assertTrue(isinstance(_postmarkup, PostMarkup))
+        with instrument() as recorder:
+            html = _postmarkup(u'[b]bold[/b]', paragraphs=True)
+        self.assertTrue(u'<strong>bold</strong>' in html)
+        self.assertEqual(recorder.calls['postmarkup'], 1)
+
+    def test_middleware(self):
+        lbf_settings.INSTRUMENT = False
+        self.assertRaises(MiddlewareNotUsed, InstrumentMiddleware)
+        lbf_settings.INSTRUMENT = True
+        middleware = InstrumentMiddleware()
+        request = RequestFactory().get(reverse('lbforum_index'))
+        request.user = AnonymousUser()
+        middleware.process_request(request)
+        middleware.process_view(request, views.index, (), {})
+        response = views.index(request).render()
+        response = middleware.process_response(request, response)
+        header = response['Server-Timing']
+        self.assertTrue('sql;dur=' in header)
+        self.assertFalse('template;dur=0.0;desc="0 calls"' in header)
+        histograms = get_histograms()['lbforum.views.IndexView']
+        self.assertEqual(sum(histograms['total_ms']), 1)
@@ -40,6 +40,7 @@ urlpatterns = patterns(
     url(r'^$', views.index, name='lbforum_index'),
     url(r'^my-groups/$', views.my_groups, name='lbforum_my_groups'),
     url(r'^recent/$', views.recent, name='lbforum_recent'),
+    url(r'^search/$', views.search, name='lbforum_search'),
     (r'^forum/', include(forum_patterns)),
     (r'^topic/', include(topic_patterns)),
     url('^reply/new/(?P<topic_id>\d+)/$', views.new_post,
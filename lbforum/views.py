@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
+import hashlib
 
 from braces.views import LoginRequiredMixin, StaffuserRequiredMixin,\
     GroupRequiredMixin, UserPassesTestMixin
 
-from django.http import HttpResponseRedirect, HttpResponse, HttpResponseNotFound
+from django.http import HttpResponseRedirect, HttpResponse, Http404
 from django.shortcuts import render, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
@@ -14,25 +15,57 @@ from django.core.urlresolvers import reverse, reverse_lazy
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import ListView,DetailView,CreateView, DeleteView,RedirectView
 from django.core.cache import cache
+from django.db.models import Q
 from django.contrib.auth.views import redirect_to_login
 from django.core.exceptions import PermissionDenied
 from django.contrib import messages
 from lbforum.models import ForumFile
 from forms import EditPostForm, NewPostForm, ForumForm
+from forms import FORUM_ORDER_BY_CHOICES
 
 from models import Topic, Forum, Post
+import perms
+from perms import get_objs_groups
 import settings as lbf_settings
+from keyset import KeysetPaginator
+from counters import incr_topic_views, set_live_views, LiveViewsList
+import objcache
+import instrument
+from latest import get_recent_topics, TopicIdList
+from search import search as search_posts, PostIdList
 from lbforum.forms import ForumFileForm
 
 from django.conf import settings
 
-def get_objs_groups(obj):
-    ck = '{0}-{1}-groups'.format(obj.pk,obj.__class__.__name__.lower())
-    groups = cache.get(ck)
-    if not groups:
-        groups = obj.groups.values_list("name",flat=True)
-        cache.set(ck,groups,500)
-    return groups
+def get_visible_forum_ids(user, show_exam_aid=False):
+    '''
+    Ids of the forums a user may see, computed in one query and cached per
+    set of user groups under the current forum permissions generation.
+    :param user: The user, may be anonymous
+    :param show_exam_aid: Include the exam aid forums
+    '''
+    if user.is_superuser:
+        group_names = None
+        groups_key = 'superuser'
+    else:
+        group_names = []
+        if user.is_authenticated():
+            group_names = sorted(get_objs_groups(user))
+        groups_key = hashlib.md5(
+            u'\n'.join(group_names).encode('utf-8')).hexdigest()
+    ck = 'visible-forums-{0}-{1}-{2}'.format(perms.get_generation(perms.FORUM),
+                                             int(show_exam_aid), groups_key)
+    forum_ids = cache.get(ck)
+    instrument.cache_lookup('visible_forums', forum_ids is not None)
+    if forum_ids is None:
+        qs = Forum.objects.all()
+        if not show_exam_aid:
+            qs = qs.exclude(groups__name=settings.FORUM_EXAM_AID_GROUP_NAME)
+        if group_names is not None:
+            qs = qs.filter(Q(groups=None) | Q(groups__name__in=group_names))
+        forum_ids = list(qs.values_list('id', flat=True).distinct())
+        cache.set(ck, forum_ids, lbf_settings.PERMS_CACHE_TIMEOUT)
+    return forum_ids
 
 class IndexView(ListView):
     template_name = 'lbforum/index.html'
@@ -42,27 +75,9 @@ class IndexView(ListView):
     show_exam_aid = False
     
     def get_queryset(self):
-        if self.show_exam_aid:
-            qs = self.model.objects.all()
-        else:
-            qs = self.model.objects.exclude(
-                groups__name=settings.FORUM_EXAM_AID_GROUP_NAME)
-        
-        users_forums = []
-        for forum in qs:
-            forum_groups = get_objs_groups(forum)
-            if len(forum_groups) != 0:
-                if self.request.user.is_authenticated():
-                    if self.request.user.is_superuser:
-                        users_forums.append(forum)
-                    else:
-                        user_groups = get_objs_groups(self.request.user)
-                        is_authorized = bool(set(forum_groups).intersection(user_groups))
-                        if is_authorized:
-                            users_forums.append(forum)
-            else:
-                users_forums.append(forum)
-        return users_forums
+        forum_ids = get_visible_forum_ids(self.request.user,
+                                          self.show_exam_aid)
+        return self.model.objects.filter(pk__in=forum_ids)
     
 index = IndexView.as_view()
 
@@ -75,13 +90,38 @@ my_groups = MyGroups.as_view()
 
 class RecentView(ListView):
     template_name = 'lbforum/recent.html'
+    context_object_name = 'topics'
+    paginate_by = 20
     
     def get_queryset(self):
-        topics = Topic.objects.all().order_by('-last_reply_on')
-        return topics.select_related()
+        forum_ids = get_visible_forum_ids(self.request.user)
+        topic_ids = [topic_id for last_reply_on, topic_id, forum_id
+                     in get_recent_topics(forum_ids)]
+        return LiveViewsList(TopicIdList(topic_ids))
+    
+    def get_context_data(self, **kwargs):
+        context = super(RecentView,self).get_context_data(**kwargs)
+        context['FORUM_PAGE_SIZE'] = self.paginate_by
+        return context
     
 recent = RecentView.as_view()
 
+class SearchView(ListView):
+    template_name = 'lbforum/search.html'
+    context_object_name = 'posts'
+    
+    def get_queryset(self):
+        self.query = self.request.GET.get('q', '').strip()
+        forum_ids = get_visible_forum_ids(self.request.user)
+        return PostIdList(search_posts(self.query, forum_ids))
+    
+    def get_context_data(self, **kwargs):
+        context = super(SearchView,self).get_context_data(**kwargs)
+        context['q'] = self.query
+        return context
+    
+search = SearchView.as_view()
+
 class ForumGroupRequiredMixin(GroupRequiredMixin):
     
     def get_forum(self):
@@ -90,37 +130,40 @@ class ForumGroupRequiredMixin(GroupRequiredMixin):
     def check_membership(self, groups):
         if groups == None:
             return True
-        return super(ForumGroupRequiredMixin,self).check_membership(groups)
+        if self.request.user.is_superuser:
+            return True
+        return bool(get_objs_groups(self.request.user) & frozenset(groups))
     
     def get_group_required(self):
-        groups = self.get_forum().groups.values_list("name", flat=True)
+        groups = get_objs_groups(self.get_forum())
         if groups:
             return groups
         return None
+    
+    def get_object(self, queryset=None):
+        # the object loaded by get_forum for the permission check
+        if queryset is None and getattr(self, 'object', None) is not None:
+            return self.object
+        return super(ForumGroupRequiredMixin,self).get_object(queryset)
         
     def dispatch(self, request, *args, **kwargs):
-        response = super(GroupRequiredMixin,self).dispatch(request,*args,**kwargs)
         self.request = request
-        try:
-            self.object = self.get_object()
-        except AttributeError:
-            pass
-        if not self.get_group_required():
-            return response
-        in_group = False
-        if self.request.user.is_authenticated():
-            in_group = self.check_membership(self.get_group_required())
-
-        if not in_group:
-            if self.raise_exception:
-                raise PermissionDenied
-            else:
+        self.args = args
+        self.kwargs = kwargs
+        groups = self.get_group_required()
+        if groups is not None:
+            in_group = False
+            if self.request.user.is_authenticated():
+                in_group = self.check_membership(groups)
+            if not in_group:
+                if self.raise_exception:
+                    raise PermissionDenied
                 messages.error(request, 'You do not have permission to view this page.')
                 return redirect_to_login(
                     request.get_full_path(),
                     self.get_login_url(),
                     self.get_redirect_field_name())
-        return response
+        return super(GroupRequiredMixin,self).dispatch(request,*args,**kwargs)
     
 class ForumView(ForumGroupRequiredMixin,DetailView):
     template_name = 'lbforum/forum.html'
@@ -128,34 +171,73 @@ class ForumView(ForumGroupRequiredMixin,DetailView):
     context_object_name = 'forum'
     slug_url_kwarg = 'forum_slug'
     def get_forum(self):
+        if getattr(self, 'object', None) is None:
+            self.object = self.get_object()
         return self.object
     
     def get_context_data(self, **kwargs):
         context = super(ForumView,self).get_context_data(**kwargs)
         topics = self.object.topic_set.all()
         order_by = self.request.GET.get('order_by','-last_reply_on')
-        context['topics'] = topics.order_by('-sticky', order_by).select_related()
+        context['topics'] = LiveViewsList(
+            topics.order_by('-sticky', order_by).select_related())
         context['form'] = ForumForm(self.request.GET)
         context['FORUM_PAGE_SIZE'] = 20
+        if lbf_settings.KEYSET_PAGINATION:
+            if order_by not in dict(FORUM_ORDER_BY_CHOICES):
+                order_by = '-last_reply_on'
+            paginator = KeysetPaginator(topics.select_related(),
+                                        ('-sticky', order_by, '-id'),
+                                        context['FORUM_PAGE_SIZE'],
+                                        count=self.object.num_topics)
+            page = paginator.page(self.request)
+            set_live_views(page.object_list)
+            context.update({'topics': page.object_list, 'page_obj': page,
+                            'keyset_page': page})
         return context
     
 forum = ForumView.as_view()
 
+def get_topic_posts(topic):
+    '''
+    Posts of a topic with everything inc_post_detail.html needs loaded in a
+    fixed number of queries, whatever the page size: authors, their profiles
+    and online status are joined in, and the attachments of the evaluated
+    slice (the current page) come from one extra query.
+    '''
+    posts = topic.posts
+    if lbf_settings.STICKY_TOPIC_POST:
+        posts = posts.filter(topic_post=False)
+    posts = posts.order_by('created_on').select_related(
+        'topic', 'posted_by', 'posted_by__lbforum_profile',
+        'posted_by__online')
+    return posts.prefetch_related('attachments')
+
 class TopicView(ForumGroupRequiredMixin,DetailView):
     model = Topic
+    queryset = Topic.objects.select_related('forum')
     context_object_name = 'topic'
     template_name = 'lbforum/topic.html'
     pk_url_kwarg = 'topic_id'
     def get_forum(self):
+        if getattr(self, 'object', None) is None:
+            self.object = self.get_object()
         return self.object.forum
     
     def get_context_data(self, **kwargs):
         context = super(TopicView,self).get_context_data(**kwargs)
-        posts = self.object.posts
-        if lbf_settings.STICKY_TOPIC_POST:
-            posts = posts.filter(topic_post=False)
-        posts = posts.order_by('created_on').select_related()
-        context['posts'] = posts
+        context['posts'] = get_topic_posts(self.object)
+        incr_topic_views(self.object.pk)
+        if lbf_settings.KEYSET_PAGINATION:
+            count = self.object.num_replies
+            if lbf_settings.STICKY_TOPIC_POST:
+                count -= 1
+            paginator = KeysetPaginator(context['posts'], ('created_on', 'id'),
+                                        settings.CTX_CONFIG['TOPIC_PAGE_SIZE'],
+                                        count=count)
+            page = paginator.page(self.request)
+            context.update({'posts': page.object_list, 'page_obj': page,
+                            'keyset_page': page})
         context['has_replied'] = self.object.has_replied(self.request.user)
         return context
     
@@ -172,27 +254,36 @@ def markitup_preview(request, template_name="lbforum/markitup_preview.html"):
 
 def get_cached_obj(pk,model_name,model_class,cache_timeout=500,get_or_404=True):
     '''
-    Using a primary key retrive object from the database or from the cache.
+    Kept for backwards compatibility, use lbforum.objcache.get_cached_obj.
     :param pk: Primary key
-    :param model_name: Name of the model to use for the cache key
+    :param model_name: Unused, the cache key is namespaced by model_class
     :param model_class: The Django model class to query if the object is 
     not in the cache
     '''
-    if pk == None:
-        return None
-    ck = '{0}-forum'.format(pk)
-    obj = cache.get(ck)
-    if not obj:
-        if get_or_404:
-            obj = get_object_or_404(model_class,pk=pk)
-        else:
-            try:
-                obj = model_class.objects.get(pk=pk)
-            except model_class.DoesNotExist:
-                obj = None
-        if obj:
-            cache.set(ck,obj,cache_timeout)
-    return obj
+    return objcache.get_cached_obj(model_class, pk, cache_timeout, get_or_404)
+
+def get_new_post_objs(topic_id=None, forum_id=None, qid=None):
+    '''
+    The topic, the forum and the quoted post of a new post, from two object
+    cache round trips: the forum of a reply and the author of the quoted
+    post are only known once the topic and the post are loaded.
+    Returns ``(topic, forum, quote)``, quote is a ``(post, author)`` pair
+    or None; raises Http404 when one of them doesn't exist.
+    '''
+    topic, forum, qpost = objcache.get_objs(
+        [(Topic, topic_id), (Forum, forum_id), (Post, qid)])
+    if topic_id and topic is None or qid and qpost is None:
+        raise Http404
+    author = None
+    if topic or qpost:
+        topic_forum, author = objcache.get_objs(
+            [(Forum, topic and topic.forum_id),
+             (User, qpost and qpost.posted_by_id)])
+        if topic:
+            forum = topic_forum
+    if forum is None or qpost and author is None:
+        raise Http404
+    return topic, forum, qpost and (qpost, author)
 
 class NewPostView(ForumGroupRequiredMixin,LoginRequiredMixin,CreateView):
     model = Post
@@ -200,22 +291,13 @@ class NewPostView(ForumGroupRequiredMixin,LoginRequiredMixin,CreateView):
     template_name = 'lbforum/post.html'
     
     def dispatch(self, request, *args, **kwargs):
-        handler = super(NewPostView,self).dispatch(request,*args,**kwargs)
-        self.forum_id = self.kwargs.get('forum_id')
-        self.topic_id = self.kwargs.get('topic_id')
-        self._forum = self.get_forum()
-        self._topic = self.get_topic()
-        return handler
+        self.forum_id = kwargs.get('forum_id')
+        self.topic_id = kwargs.get('topic_id')
+        self._topic, self._forum, self._quote = get_new_post_objs(
+            self.topic_id, self.forum_id, request.GET.get('qid'))
+        return super(NewPostView,self).dispatch(request,*args,**kwargs)
     
     def get_forum(self):
-        try:
-            return self._forum
-        except AttributeError:
-            pass
-        if self.topic_id:
-            self._forum = get_cached_obj(self.topic_id, 'topic', Topic).forum
-            return self._forum
-        self._forum = get_cached_obj(self.forum_id, 'forum', Forum)
         return self._forum
     
     def post(self, request, *args, **kwargs):
@@ -227,18 +309,13 @@ class NewPostView(ForumGroupRequiredMixin,LoginRequiredMixin,CreateView):
             return self.form_invalid(form)
         
     def get_topic(self):
-        try:
-            return self._topic
-        except AttributeError:
-            pass
-        self._topic = get_cached_obj(self.topic_id,'topic',Topic,get_or_404=False)
         return self._topic
     
         
     def get_form_kwargs(self):
         kwargs = super(NewPostView,self).get_form_kwargs()
         kwargs.update({'user':self.request.user,'forum':self._forum,
-                       'topic':get_cached_obj(self.topic_id, 'topic', Topic),
+                       'topic':self.get_topic(),
                        'ip':self.request.META.get('REMOTE_ADDR')})
         return kwargs
     
@@ -254,11 +331,10 @@ class NewPostView(ForumGroupRequiredMixin,LoginRequiredMixin,CreateView):
     
     def get_initial(self):
         initial = super(NewPostView,self).get_initial()
-        qid = self.request.GET.get('qid')
-        if qid:
-            qpost = get_cached_obj(qid, 'post', Post)
+        if self._quote:
+            qpost, author = self._quote
             initial['message'] = "[quote={0}]{1}[/quote]".format(
-                qpost.posted_by.username, qpost.message)
+                author.username, qpost.message)
         return initial
     
     def get_success_url(self):
@@ -292,16 +368,14 @@ class NewPostView(ForumGroupRequiredMixin,LoginRequiredMixin,CreateView):
 def new_post(request, forum_id=None, topic_id=None, form_class=NewPostForm,
         template_name='lbforum/post.html',forum_reverse_string="lbforum_forum",
         topic_reverse_string='lbforum_topic'):
-    qpost = topic = forum = first_post = preview = None
+    first_post = preview = None
     post_type = _('topic')
     topic_post = True
-    if forum_id:
-        forum = get_object_or_404(Forum, pk=forum_id)
-    if topic_id:
+    qid = request.method != "POST" and request.GET.get('qid', '') or None
+    topic, forum, quote = get_new_post_objs(topic_id, forum_id, qid)
+    if topic:
         post_type = _('reply')
         topic_post = False
-        topic = get_object_or_404(Topic, pk=topic_id)
-        forum = topic.forum
         first_post = topic.posts.order_by('created_on').select_related()[0]
         
     if request.method == "POST":
@@ -317,11 +391,10 @@ def new_post(request, forum_id=None, topic_id=None, form_class=NewPostForm,
                                                     args=[forum.slug]))
     else:
         initial = {}
-        qid = request.GET.get('qid', '')
-        if qid:
-            qpost = get_object_or_404(Post, id=qid)
+        if quote:
+            qpost, author = quote
             initial['message'] = "[quote=%s]%s[/quote]"
-            initial['message'] %= (qpost.posted_by.username, qpost.message)
+            initial['message'] %= (author.username, qpost.message)
         form = form_class(initial=initial, forum=forum)
     ext_ctx = {
         'forum': forum,
@@ -386,33 +459,33 @@ class UserTopicsView(ListView):
     context_object_name = 'topics'
     template_name = 'lbforum/account/user_topics.html'
     
+    def get_view_user(self):
+        if not hasattr(self, '_view_user'):
+            self._view_user = objcache.get_cached_obj(
+                User, self.kwargs.get('user_id'))
+        return self._view_user
+    
     def get_queryset(self):
-        view_user = get_cached_obj(self.kwargs.get('user_id'), 'user', User)
+        view_user = self.get_view_user()
         topics = view_user.topic_set.order_by('-created_on').select_related()
-        return topics
+        return LiveViewsList(topics)
     
     def get_context_data(self, **kwargs):
         context = super(UserTopicsView,self).get_context_data(**kwargs)
-        context['view_user'] = get_cached_obj(self.kwargs.get('user_id'), 'user', User)
+        context['view_user'] = self.get_view_user()
         return context
     
 user_topics = UserTopicsView.as_view()
 
-class UserPostsView(ListView):
+class UserPostsView(UserTopicsView):
     context_object_name = 'posts'
     template_name = 'lbforum/account/user_posts.html'
     
     def get_queryset(self):
-        view_user = get_cached_obj(self.kwargs.get('user_id'), 'user', User)
+        view_user = self.get_view_user()
         posts = view_user.post_set.order_by('-created_on').select_related()
         return posts
     
-    def get_context_data(self, **kwargs):
-        context = super(UserPostsView,self).get_context_data(**kwargs)
-        context['view_user'] = get_cached_obj(self.kwargs.get('user_id'),
-                                              'user', User)
-        return context
-    
 user_posts = UserPostsView.as_view()
 
 class DeleteTopicView(StaffuserRequiredMixin,DeleteView):
@@ -478,7 +551,7 @@ class FileForumGroupRequiredMixin(ForumGroupRequiredMixin):
             self._forum = Forum.objects.get(slug=self.kwargs.get('forum_slug'))
             return self._forum
         except Forum.DoesNotExist:
-            raise HttpResponseNotFound
+            raise Http404
     
 class ForumFileListView(LoginRequiredMixin,FileForumGroupRequiredMixin,ListView):
     model = ForumFile